@@ -2,9 +2,13 @@
 # This program is free software licensed under the GNU Affero General Public License.
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
+import numpy as np
+
+B64ENCODESTR = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+-"
+
 class B64:
     def __init__(self):
-        self.encodestr="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+-"
+        self.encodestr=B64ENCODESTR
         #establish the inversion table:
         self.invencode=[]
         for i in range(0,255): self.invencode.append(0)
@@ -47,18 +51,121 @@ class B64:
         return [x for x in reversed(rs)]
 
 
+#Lookup table converting 6 bit digits to their B64 character code
+_DIGITTABLE = np.frombuffer(B64ENCODESTR, dtype=np.uint8)
+
+#Lookup table converting B64 character codes to their 6 bit digit (unknown characters give 0)
+_INVERSETABLE = np.zeros(256, dtype=np.uint8)
+_INVERSETABLE[_DIGITTABLE] = np.arange(len(_DIGITTABLE))
+
+#Largest magnitude handled by the vectorised encoders (larger values use the plain Python implementations)
+_MAXINT = 2**53
+
+
+#Converts a list of numbers to a 1D numeric numpy array
+#Returns None if this is not possible without changing the values (e.g. None, Decimal or very large integers)
+def _NumericArray(vals):
+    try:
+        array = np.asarray(vals)
+    except (ValueError, TypeError):
+        return None
+    if (array.ndim != 1) or (array.dtype.kind not in 'iuf'):
+        return None
+    if len(array) == 0:
+        return array
+    if array.dtype.kind == 'f':
+        if not np.all(np.isfinite(array)):
+            return None
+        if np.max(np.abs(array)) >= _MAXINT:
+            return None
+    else:
+        if (int(array.max()) >= _MAXINT) or (int(array.min()) <= -_MAXINT):
+            return None
+        array = array.astype(np.int64)
+    return array
+
+
+#Vectorised equivalent of ','.join([B64().Int2B64(x) for x in codes]), for an int64 array
+def _JoinB64(codes):
+    if len(codes) == 0:
+        return ''
+    digitcounts = np.ones(len(codes), dtype=np.int64)
+    rest = codes >> 6
+    while np.any(rest > 0):
+        digitcounts += (rest > 0)
+        rest >>= 6
+    maxdigits = int(digitcounts.max())
+    shifts = 6 * np.arange(maxdigits - 1, -1, -1)
+    chars = np.empty((len(codes), maxdigits + 1), dtype=np.uint8)
+    chars[:, :maxdigits] = _DIGITTABLE[(codes[:, np.newaxis] >> shifts) & 63]
+    chars[:, maxdigits] = ord(',')
+    #Leading positions beyond the digit count of a value are dropped
+    used = np.arange(maxdigits + 1) >= (maxdigits - digitcounts)[:, np.newaxis]
+    return chars[used].tostring()[:-1]
+
+
+#Vectorised equivalent of ''.join([B64().Int2B64(x, digitcount) for x in codes]), for a non-negative int64 array
+#Positions flagged in absent are encoded as '~' * digitcount
+def _ConcatB64(codes, digitcount, absent):
+    shifts = 6 * np.arange(digitcount - 1, -1, -1)
+    chars = _DIGITTABLE[(codes[:, np.newaxis] >> shifts) & 63]
+    chars[absent] = ord('~')
+    return chars.tostring()
+
+
+#Vectorised form of B64.B642BooleanList, decoding many flag lists at once
+#chars is a 2D uint8 array of character codes, each row holding the (valueCount+5)//6 characters of one flag list
+#Returns a boolean matrix with valueCount flags per row
+def B642BooleanMatrix(chars, valueCount):
+    chars = np.asarray(chars, dtype=np.uint8)
+    #The 6 bits of each digit, most significant first; the flags are the last valueCount bits of a row
+    bits = np.unpackbits(_INVERSETABLE[chars][:, :, np.newaxis], axis=2)[:, :, 2:]
+    bits = bits.reshape(chars.shape[0], 6 * chars.shape[1])
+    return bits[:, bits.shape[1] - valueCount:].astype(bool)
+
+
 class ValueListCoder:
     def __init__(self):
         self.b64codec=B64()
 
 
     def EncodeIntegers(self, vals):
+        if isinstance(vals, np.ndarray):
+            vals = vals.tolist()
         result={}
         result['Encoding']="Integer"
         result['Data']=','.join([str(x) for x in vals])
         return result
 
     def EncodeIntegersByDifferenceB64(self, vals):
+        array = _NumericArray(vals)
+        if array is None:
+            return self._EncodeIntegersByDifferenceB64List(vals)
+        result={}
+        result['Encoding']="IntegerDiffB64"
+        if len(array) == 0:
+            result['Offset']=0
+            result['Data']=''
+            return result
+        if isinstance(vals, np.ndarray):
+            MinValX=array.min().item()
+        else:
+            MinValX=min(vals)
+        result['Offset']=MinValX
+        diffs = np.diff(np.concatenate(([array.min()], array)))
+        if np.any(diffs < 0):
+            raise Exception("EncodeIntegersByDifferenceB64: list should be increasing in size")
+        if diffs.max() >= _MAXINT:
+            return self._EncodeIntegersByDifferenceB64List(vals)
+        if array.dtype.kind == 'f':
+            #Rounds half away from zero, as round() does for these non-negative values
+            rounded = np.floor(diffs)
+            rounded += (diffs - rounded >= 0.5)
+            diffs = rounded.astype(np.int64)
+        result['Data']=_JoinB64(diffs)
+        return result
+
+    def _EncodeIntegersByDifferenceB64List(self, vals):
         result={}
         MinValX=0
         if vals:
@@ -76,6 +183,15 @@ class ValueListCoder:
         return result
 
     def EncodeIntegersB64(self, vals):
+        array = _NumericArray(vals)
+        if array is None:
+            return self._EncodeIntegersB64List(vals)
+        result={}
+        result['Encoding']="IntegerB64"
+        result['Data']=_JoinB64(np.trunc(array.astype(np.float64) + 0.5).astype(np.int64))
+        return result
+
+    def _EncodeIntegersB64List(self, vals):
         result={}
         result['Encoding']="IntegerB64"
         result['Data']=','.join([self.b64codec.Int2B64(int(0.5+x)) for x in vals])
@@ -83,6 +199,51 @@ class ValueListCoder:
 
 
     def EncodeFloatsByIntB64(self, vals, bytecount):
+        #Absent values are None in lists, and NaN in float numpy arrays
+        if isinstance(vals, np.ndarray) and (vals.ndim == 1) and (vals.dtype.kind in 'iuf'):
+            values = vals.astype(np.float64)
+            absent = np.isnan(values)
+        else:
+            try:
+                values = np.array(vals, dtype=np.float64)
+            except (ValueError, TypeError):
+                return self._EncodeFloatsByIntB64List(vals, bytecount)
+            absent = np.isnan(values)
+            if values.ndim != 1:
+                return self._EncodeFloatsByIntB64List(vals, bytecount)
+            #None is converted to NaN; actual NaN values are left to the plain implementation
+            for idx in np.flatnonzero(absent):
+                if vals[idx] is not None:
+                    return self._EncodeFloatsByIntB64List(vals, bytecount)
+        present = values[~absent]
+        if not np.all(np.isfinite(present)):
+            return self._EncodeFloatsByIntB64List(vals, bytecount)
+
+        result={}
+        result['Encoding']="FloatAsIntB64"
+        MinVal=0
+        MaxVal=1
+        if len(present) > 0:
+            MinVal=float(present.min())
+            MaxVal=float(present.max())
+            if MaxVal==MinVal: MaxVal=MinVal+1
+
+        CompressedRange=int(64**bytecount-10)
+        Offset=1.0*MinVal
+        Slope=1.0*(MaxVal-MinVal)/CompressedRange
+        if (Slope == 0):
+           Slope = 1
+        result['Offset']=Offset
+        result['Slope']=Slope
+        result['ByteCount']=bytecount
+        values[absent] = Offset
+        codes = np.trunc((values - Offset) / Slope)
+        if (len(codes) > 0) and ((codes.min() < 0) or (codes.max() >= 64**bytecount)):
+            return self._EncodeFloatsByIntB64List(vals, bytecount)
+        result['Data']=_ConcatB64(codes.astype(np.int64), bytecount, absent)
+        return result
+
+    def _EncodeFloatsByIntB64List(self, vals, bytecount):
         result={}
         result['Encoding']="FloatAsIntB64"
         MinVal=0
@@ -110,6 +271,8 @@ class ValueListCoder:
 
 
     def EncodeFloatsH(self, vals):
+        if isinstance(vals, np.ndarray):
+            vals = [None if vl != vl else vl for vl in vals.tolist()]
         result={}
         result['Encoding']="FloatAsH"
         result['Data']=','.join(
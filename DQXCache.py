@@ -0,0 +1,93 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+import threading
+import time
+from collections import OrderedDict
+
+
+#Returns an estimate of the memory used by a cached value, in bytes
+def EstimateSize(value):
+    if isinstance(value, basestring):
+        return len(value) + 40
+    if isinstance(value, dict):
+        return 100 + sum(EstimateSize(k) + EstimateSize(v) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return 60 + sum(EstimateSize(v) for v in value)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes + 100
+    return 24
+
+
+# A thread safe key-value cache, evicting the least recently used entries when more than maxCount are held,
+# or when the estimated size of all values exceeds maxBytes
+# If ttl is specified, entries older than ttl seconds are considered absent
+class LRUCache(object):
+    def __init__(self, maxCount=None, ttl=None, maxBytes=None, sizeFunc=EstimateSize):
+        self.maxCount = maxCount
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.sizeFunc = sizeFunc
+        self.lock = threading.Lock()
+        self.items = OrderedDict() #maps key to (value, time stored, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def Get(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            if (self.ttl is not None) and (time.time() - item[1] > self.ttl):
+                self.bytes -= item[2]
+                self.misses += 1
+                return default
+            self.items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def Set(self, key, value):
+        size = self.sizeFunc(value) if self.maxBytes is not None else 0
+        if (self.maxBytes is not None) and (size > self.maxBytes):
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self.items[key] = (value, time.time(), size)
+            self.bytes += size
+            while ((self.maxCount is not None) and (len(self.items) > self.maxCount)) or ((self.maxBytes is not None) and (self.bytes > self.maxBytes)):
+                evicted = self.items.popitem(last=False)[1]
+                self.bytes -= evicted[2]
+                self.evictions += 1
+
+    def Remove(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                self.bytes -= item[2]
+
+    def Clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def GetStatistics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.items),
+                'bytes': self.bytes,
+                'maxBytes': self.maxBytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': (1.0 * self.hits / lookups) if lookups > 0 else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self.items)
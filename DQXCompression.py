@@ -0,0 +1,122 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+import zlib
+
+__all__ = ['CompressionMiddleware']
+
+# zlib window settings for the supported content codings
+_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# Content types that are already compressed, and gain nothing from another pass
+_COMPRESSED_TYPES = ['image/', 'video/', 'audio/', 'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2']
+
+
+#Returns the preferred content coding ('gzip' or 'deflate') acceptable to the client, or None
+def ChooseEncoding(acceptEncoding):
+    qualities = {}
+    for item in acceptEncoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    for coding in ['gzip', 'deflate']:
+        if qualities.get(coding, qualities.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+# WSGI middleware compressing responses with gzip or deflate, as negotiated from the Accept-Encoding request header
+# Responses are compressed while they are streamed, so that generator responses (e.g. downloadtable) are never
+# held in memory as a whole. Only the first minSize bytes are buffered, to decide whether compression is worthwhile
+class CompressionMiddleware(object):
+    def __init__(self, application, minSize=1024, level=6):
+        self._application = application
+        self._minSize = minSize
+        self._level = level
+
+    def __call__(self, environ, start_response):
+        encoding = ChooseEncoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self._application(environ, start_response)
+        return self._Respond(environ, start_response, encoding)
+
+    def _ShouldCompress(self, status, headers, size):
+        if size < self._minSize:
+            return False
+        if status[:3] in ['204', '206', '304']:
+            return False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if (name == 'content-type') and any(value.lower().startswith(tpe) for tpe in _COMPRESSED_TYPES):
+                return False
+        return True
+
+    def _Respond(self, environ, start_response, encoding):
+        response = {}
+        written = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            response['exc_info'] = exc_info
+            return written.append
+
+        result = self._application(environ, capture_start_response)
+        try:
+            iterator = iter(result)
+
+            #Buffer the start of the body, until it is clear whether it is worth compressing
+            buffered = written
+            size = sum(len(chunk) for chunk in written)
+            finished = True
+            for chunk in iterator:
+                if chunk:
+                    buffered.append(chunk)
+                    size += len(chunk)
+                if size >= self._minSize:
+                    finished = False
+                    break
+
+            status, headers = response['status'], response['headers']
+            if not self._ShouldCompress(status, headers, size):
+                start_response(status, headers, response['exc_info'])
+                for chunk in buffered:
+                    yield chunk
+                if not finished:
+                    for chunk in iterator:
+                        yield chunk
+                return
+
+            headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', encoding))
+            headers.append(('Vary', 'Accept-Encoding'))
+            start_response(status, headers, response['exc_info'])
+
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, _WBITS[encoding])
+            for chunk in buffered:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            if not finished:
+                for chunk in iterator:
+                    data = compressor.compress(chunk)
+                    if data:
+                        yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
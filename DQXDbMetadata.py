@@ -0,0 +1,120 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# Process wide cache of database metadata: the list of datasets, and the columns & indexes of tables
+# Entries are revalidated after METADATA_TTL seconds. A table is only reloaded if its UPDATE_TIME or
+# CREATE_TIME in information_schema changed, so that revalidation normally costs a single cheap query
+
+import time
+from collections import OrderedDict
+
+import config
+import DQXCache
+import DQXDbTools
+
+metadataTTL = getattr(config, 'METADATA_TTL', 60)
+
+_datasets = DQXCache.LRUCache(maxCount=1, ttl=metadataTTL)
+_tables = DQXCache.LRUCache(maxCount=getattr(config, 'METADATA_MAXTABLES', 2000))
+
+
+# Describes the structure of a single database table
+class TableInfo(object):
+    def __init__(self, databaseName, tableName, createTime, updateTime):
+        self.databaseName = databaseName
+        self.tableName = tableName
+        self.createTime = createTime
+        self.updateTime = updateTime
+        self.columns = OrderedDict() #maps column name to MySQL data type
+        self.indexes = OrderedDict() #maps index name to {'Unique': bool, 'Columns': [column names]}
+        self._columnsLower = set()
+        self.checked = time.time()
+
+    def AddColumn(self, name, dataType):
+        self.columns[name] = dataType
+        self._columnsLower.add(name.lower())
+
+    def AddIndexColumn(self, indexName, unique, columnName):
+        if indexName not in self.indexes:
+            self.indexes[indexName] = {'Unique': unique, 'Columns': []}
+        self.indexes[indexName]['Columns'].append(columnName)
+
+    #Note: MySQL column names are case insensitive
+    def HasColumn(self, columnName):
+        return columnName.lower() in self._columnsLower
+
+    def GetPrimaryKey(self):
+        if 'PRIMARY' in self.indexes:
+            return self.indexes['PRIMARY']['Columns']
+        return None
+
+
+#Returns the list of dataset identifiers
+def GetDatasets():
+    datasets = _datasets.Get('datasets')
+    if datasets is None:
+        with DQXDbTools.DBCursor() as cur:
+            cur.execute('select id from datasetindex')
+            datasets = [d[0] for d in cur.fetchall()]
+        _datasets.Set('datasets', datasets)
+    return datasets
+
+
+def _FetchTableTimes(cur, databaseName, tableName):
+    cur.execute('SELECT CREATE_TIME, UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s', (databaseName, tableName))
+    return cur.fetchone()
+
+
+def _LoadTableInfo(cur, databaseName, tableName, times):
+    info = TableInfo(databaseName, tableName, times[0], times[1])
+    cur.execute('SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s ORDER BY ORDINAL_POSITION', (databaseName, tableName))
+    for columnName, dataType in cur.fetchall():
+        info.AddColumn(columnName, dataType)
+    cur.execute('SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s ORDER BY INDEX_NAME, SEQ_IN_INDEX', (databaseName, tableName))
+    for indexName, nonUnique, columnName in cur.fetchall():
+        info.AddIndexColumn(indexName, int(nonUnique) == 0, columnName)
+    return info
+
+
+#Returns the TableInfo of a table, or None if the table is not known in information_schema
+#cur is an open DQXDbTools.DBCursor, used when the cached information has to be (re)validated
+def GetTableInfo(cur, tableName, databaseName=None):
+    databaseName = databaseName or cur.db_args['db']
+    key = (databaseName, tableName)
+    info = _tables.Get(key)
+    if (info is not None) and (time.time() - info.checked <= metadataTTL):
+        return info
+    times = _FetchTableTimes(cur, databaseName, tableName)
+    if times is None:
+        _tables.Remove(key)
+        return None
+    if (info is not None) and (info.createTime == times[0]) and (info.updateTime == times[1]):
+        info.checked = time.time()
+        return info
+    info = _LoadTableInfo(cur, databaseName, tableName, times)
+    _tables.Set(key, info)
+    return info
+
+
+#Forces a reload of the metadata of a table the next time it is requested
+def InvalidateTable(databaseName, tableName):
+    _tables.Remove((databaseName, tableName))
+
+
+def InvalidateAll():
+    _datasets.Clear()
+    _tables.Clear()
+
+
+#Raises an exception if any of the column names does not exist in the table
+#If no metadata is available for the table, the check is left to MySQL
+def VerifyColumns(cur, tableName, columnNames, databaseName=None):
+    info = GetTableInfo(cur, tableName, databaseName)
+    if (info is None) or (len(info.columns) == 0):
+        return
+    for columnName in columnNames:
+        if (columnName == 'count(*)') or (len(columnName) == 0):
+            continue
+        if not info.HasColumn(columnName):
+            raise Exception('Invalid column name {0} for table {1}'.format(columnName, tableName))
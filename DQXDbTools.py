@@ -5,13 +5,22 @@
 
 import simplejson
 import DQXbase64
+import DQXCache
+import DQXMetrics
+import lzstring
 import MySQLdb
+import MySQLdb.cursors
 import config
 import time
+import threading
+import re
+import collections
+import Queue
 
 MySQLMinVersion = [5, 6]
 
-LogRequests = True
+#Print every query and its parameters (see also SlowQueryLog, which only keeps the slow ones)
+LogRequests = getattr(config, 'LOG_REQUESTS', True)
 
 
 # Enumerates types of actions that can be done on a database entity
@@ -169,6 +178,346 @@ class CredentialInformation:
 class Timeout(Exception):
     pass
 
+#Raised by a DBCursor whose statements were cancelled from another thread (see DBCursor.Cancel)
+class Cancelled(Exception):
+    pass
+
+# Process-wide pool of open MySQL connections, shared by all DBCursor instances
+# Connections are grouped by the arguments they were opened with, so that a borrowed connection is always
+# equivalent to a freshly opened one
+class ConnectionPool(object):
+    def __init__(self, maxSize, idleTimeout):
+        self.maxSize = maxSize #maximum number of idle connections kept open (0 disables pooling)
+        self.idleTimeout = idleTimeout #idle connections older than this (in seconds) are closed
+        self.lock = threading.Lock()
+        self.idle = {} #maps a connection key to a list of (connection, time returned) tuples
+        self.idleCount = 0
+        self.inUseCount = 0
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.expired = 0
+
+    @staticmethod
+    def GetKey(db_args):
+        key = (db_args.get('host'), db_args.get('db'), db_args.get('user'), db_args.get('charset'), bool(db_args.get('autocommit', False)))
+        #Any other connection argument (e.g. timeouts, option files) also has to match
+        others = tuple(sorted((k, v) for k, v in db_args.items() if k not in ['host', 'db', 'user', 'charset', 'autocommit']))
+        return key + others
+
+    @staticmethod
+    def _Close(db):
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+
+    #Closes all idle connections that exceeded the idle timeout. Must be called with the lock held
+    def _PurgeExpired(self, now):
+        expired = []
+        for key in self.idle.keys():
+            fresh = []
+            for db, returned in self.idle[key]:
+                if now - returned > self.idleTimeout:
+                    expired.append(db)
+                else:
+                    fresh.append((db, returned))
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+        self.idleCount -= len(expired)
+        self.expired += len(expired)
+        return expired
+
+    #Returns an open connection, either an idle one from the pool or a newly created one
+    def Acquire(self, db_args):
+        key = self.GetKey(db_args)
+        while True:
+            with self.lock:
+                expired = self._PurgeExpired(time.time())
+                db = None
+                if self.idle.get(key):
+                    db, returned = self.idle[key].pop()
+                    self.idleCount -= 1
+            for item in expired:
+                self._Close(item)
+            if db is None:
+                break
+            #Liveness check: the server may have dropped the connection while it was idle
+            try:
+                db.ping()
+            except MySQLdb.Error:
+                self._Close(db)
+                with self.lock:
+                    self.discarded += 1
+                continue
+            with self.lock:
+                self.hits += 1
+                self.inUseCount += 1
+            return db
+
+        db = MySQLdb.connect(**db_args)
+        if db_args.get('autocommit', False):
+            db.autocommit(True)
+        with self.lock:
+            self.misses += 1
+            self.inUseCount += 1
+        return db
+
+    #Hands a connection back to the pool. If reusable is False, or the pool is full, the connection is closed
+    def Release(self, db_args, db, reusable=True):
+        if reusable and not db_args.get('autocommit', False):
+            #End any implicit transaction, so that the next user does not inherit a stale snapshot or locks
+            try:
+                db.rollback()
+            except MySQLdb.Error:
+                reusable = False
+        with self.lock:
+            self.inUseCount -= 1
+            if reusable and (self.idleCount < self.maxSize):
+                self.idle.setdefault(self.GetKey(db_args), []).append((db, time.time()))
+                self.idleCount += 1
+                return
+            if reusable:
+                self.discarded += 1
+        self._Close(db)
+
+    def GetStatistics(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': (1.0 * self.hits / requests) if requests > 0 else 0.0,
+                'idle': self.idleCount,
+                'inUse': self.inUseCount,
+                'discarded': self.discarded,
+                'expired': self.expired,
+                'maxSize': self.maxSize,
+            }
+
+
+connectionPool = ConnectionPool(
+    getattr(config, 'DBPOOL_MAXSIZE', 16),
+    getattr(config, 'DBPOOL_IDLETIMEOUT', 300)
+)
+
+
+# A statement registered with the QueryWatchdog
+class WatchedStatement(object):
+    def __init__(self, conn_id, deadline):
+        self.conn_id = conn_id
+        self.deadline = deadline
+        self.killed = False
+        self.finished = threading.Event() #set once the statement is unwatched, or its KILL QUERY was issued
+
+
+# Enforces statement deadlines: a background thread issues KILL QUERY, from its own persistent admin
+# connection, for every watched statement whose deadline has passed. Only the statement is aborted
+# The KILL QUERY is issued without holding the lock on the watched statements, so that a slow or unreachable
+# server does not delay the statements that are being watched or unwatched meanwhile
+class QueryWatchdog(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.watched = [] #list of active WatchedStatement instances
+        self.adminLock = threading.Lock() #serialises the use of the admin connection
+        self.admin_args = None
+        self.adminDb = None
+        self.thread = None
+        self.killCount = 0
+
+    #Registers a statement running on connection conn_id that has to be aborted at time deadline
+    def Watch(self, conn_id, deadline, db_args):
+        entry = WatchedStatement(conn_id, deadline)
+        with self.condition:
+            if self.admin_args is None:
+                self.admin_args = dict(db_args)
+            self.watched.append(entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._Run, name='DQXQueryWatchdog')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return entry
+
+    #Stops watching a statement. Returns True if the statement was killed because its deadline passed
+    #If the KILL QUERY is being issued, waits for it, so that the connection is not reused meanwhile
+    def Unwatch(self, entry):
+        with self.condition:
+            if entry in self.watched:
+                self.watched.remove(entry)
+                entry.finished.set()
+        entry.finished.wait()
+        return entry.killed
+
+    #Immediately aborts the statement running on connection conn_id, regardless of its deadline
+    def KillNow(self, conn_id, db_args):
+        with self.condition:
+            if self.admin_args is None:
+                self.admin_args = dict(db_args)
+        return self._Kill(conn_id)
+
+    #Issues the actual KILL QUERY
+    def _Kill(self, conn_id):
+        with self.adminLock:
+            for attempt in range(2):
+                try:
+                    if self.adminDb is None:
+                        self.adminDb = MySQLdb.connect(**self.admin_args)
+                        self.adminDb.autocommit(True)
+                    cursor = self.adminDb.cursor()
+                    cursor.execute("KILL QUERY %s", (conn_id,))
+                    cursor.close()
+                    self.killCount += 1
+                    return True
+                except MySQLdb.Error:
+                    #The admin connection may have been dropped by the server: reconnect once
+                    if self.adminDb is not None:
+                        ConnectionPool._Close(self.adminDb)
+                        self.adminDb = None
+            return False
+
+    def _Run(self):
+        while True:
+            with self.condition:
+                now = time.time()
+                expired = [entry for entry in self.watched if entry.deadline <= now]
+                for entry in expired:
+                    self.watched.remove(entry)
+                if not expired:
+                    if self.watched:
+                        nextDeadline = min(entry.deadline for entry in self.watched)
+                        self.condition.wait(max(0.0, nextDeadline - now))
+                    else:
+                        self.condition.wait()
+                    continue
+            #Expired statements are no longer in the watched list: Unwatch waits for their finished event
+            for entry in expired:
+                entry.killed = self._Kill(entry.conn_id)
+                entry.finished.set()
+
+
+queryWatchdog = QueryWatchdog()
+
+
+_sqlLiteralMatcher = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\b\d+(?:\.\d+)?\b|%s""")
+_sqlWhitespaceMatcher = re.compile(r'\s+')
+
+#Returns the form of an SQL statement without literal values and parameter placeholders, which are replaced by '?'
+#Statements that only differ in their values therefore have the same normalised form
+def NormaliseSQL(query):
+    return _sqlWhitespaceMatcher.sub(' ', _sqlLiteralMatcher.sub('?', query)).strip()
+
+
+def _LoggedValue(value):
+    if (value is None) or isinstance(value, (basestring, int, long, float)):
+        return value
+    return str(value)
+
+
+# Keeps the most recent statements that took longer than threshold seconds, in a ring buffer of maxEntries records
+# For SELECT statements, the EXPLAIN plan is captured by a background thread, using a separate pooled connection,
+# so that the request that ran the statement is not delayed. Plans are reused for statements with the same
+# normalised form for a while, so that a burst of identical slow queries does not cause a burst of EXPLAINs
+class SlowQueryLog(object):
+    def __init__(self, threshold, maxEntries, explainTimeout):
+        self.threshold = threshold #None disables the log
+        self.explainTimeout = explainTimeout
+        self.lock = threading.Lock()
+        self.entries = collections.deque(maxlen=maxEntries)
+        self.explainQueue = Queue.Queue(maxsize=100)
+        self.explainCache = DQXCache.LRUCache(maxCount=500, ttl=600)
+        self.thread = None
+
+    def IsSlow(self, duration):
+        return (self.threshold is not None) and (duration >= self.threshold)
+
+    def Record(self, query, params, duration, rows, db_args):
+        context = DQXMetrics.GetContext()
+        entry = {
+            'Time': time.time(),
+            'Duration': duration,
+            'SQL': NormaliseSQL(query),
+            'Params': dict((key, _LoggedValue(value)) for key, value in params.items()) if isinstance(params, dict) else [_LoggedValue(param) for param in (params or [])],
+            'Rows': rows,
+            'Responder': context.responder if context is not None else None,
+            'Database': db_args['db'],
+            'Explain': None,
+        }
+        with self.lock:
+            self.entries.append(entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._Run, name='DQXSlowQueryExplain')
+                self.thread.daemon = True
+                self.thread.start()
+        if query.lstrip()[:6].upper() == 'SELECT':
+            try:
+                self.explainQueue.put_nowait((entry, query, params, dict(db_args)))
+            except Queue.Full:
+                with self.lock:
+                    entry['ExplainError'] = 'Explain queue full'
+
+    #Returns copies of the recorded statements, most recent first
+    def GetEntries(self):
+        with self.lock:
+            return [dict(entry) for entry in reversed(self.entries)]
+
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _Run(self):
+        while True:
+            entry, query, params, db_args = self.explainQueue.get()
+            key = (db_args['db'], entry['SQL'])
+            plan = self.explainCache.Get(key)
+            error = None
+            if plan is None:
+                try:
+                    plan = self._Explain(query, params, db_args)
+                    self.explainCache.Set(key, plan)
+                except Exception as e:
+                    error = str(e)
+            with self.lock:
+                entry['Explain'] = plan
+                if error is not None:
+                    entry['ExplainError'] = error
+
+    def _Explain(self, query, params, db_args):
+        db = connectionPool.Acquire(db_args)
+        reusable = True
+        try:
+            cursor = db.cursor()
+            watched = queryWatchdog.Watch(db.thread_id(), time.time() + self.explainTimeout, db_args)
+            try:
+                cursor.execute('EXPLAIN ' + query, params)
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, [_LoggedValue(value) for value in row])) for row in cursor.fetchall()]
+            finally:
+                if queryWatchdog.Unwatch(watched):
+                    reusable = False
+                cursor.close()
+        except MySQLdb.Error:
+            reusable = False
+            raise
+        finally:
+            connectionPool.Release(db_args, db, reusable)
+
+
+slowQueryLog = SlowQueryLog(
+    getattr(config, 'SLOWQUERY_THRESHOLD', 1.0),
+    getattr(config, 'SLOWQUERY_MAXENTRIES', 100),
+    getattr(config, 'SLOWQUERY_EXPLAINTIMEOUT', 10)
+)
+
+
+#Returns the time budget (in seconds) of a single request for a given responder
+#Per responder values can be specified in config.RESPONDER_TIMEOUTS, config.TIMEOUT is the default
+def GetResponderTimeout(responderName):
+    return getattr(config, 'RESPONDER_TIMEOUTS', {}).get(responderName, config.TIMEOUT)
+
+
 class DBCursor(object):
     def __init__(self, cred_data_or_cred=None, db=None, **kwargs):
         self.db_args = {
@@ -181,6 +530,12 @@ class DBCursor(object):
         else:
             self.db_args['read_default_file'] = '~/.my.cnf'
         self.db_args['db'] = db or config.DB
+        #Time budget for all statements executed by this cursor (read_timeout is accepted for backwards compatibility)
+        self.timeout = kwargs.pop('timeout', None)
+        if 'read_timeout' in kwargs:
+            self.timeout = kwargs.pop('read_timeout')
+        #Cursor class used on the (pooled) connection, e.g. MySQLdb.cursors.SSCursor for unbuffered results
+        self.cursorclass = kwargs.pop('cursorclass', None)
         self.db_args.update(kwargs)
 
         if type(cred_data_or_cred) == type(CredentialInformation()):
@@ -190,44 +545,98 @@ class DBCursor(object):
         self.db = None
         self.cursor = None
         self.conn_id = None
+        self.deadline = None
+        self.lock = threading.Lock()
+        self.executing = False
+        self.cancelled = False
+        self.killed = False #a statement was killed by the watchdog
+        self.discard = False #the connection is not to be reused (see DiscardConnection)
 
     def __enter__(self):
         self.credentials.VerifyCanDo(DbOperationRead(self.db_args['db']))
-        self.db = MySQLdb.connect(**self.db_args)
-        if self.db_args.get('autocommit', False):
-            self.db.autocommit(True)
-        self.cursor = self.db.cursor()
-        self.cursor.execute("SELECT CONNECTION_ID();")
-        self.conn_id = self.cursor.fetchall()[0][0]
+        if self.timeout is not None:
+            self.deadline = time.time() + self.timeout
+        self.db = connectionPool.Acquire(self.db_args)
+        self.cursor = self.db.cursor(self.cursorclass)
+        self.conn_id = self.db.thread_id()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cursor.close()
-        self.db.close()
+        #A connection that raised a connection-level error is not handed out again
+        reusable = not (exc_type is not None and issubclass(exc_type, (MySQLdb.OperationalError, MySQLdb.InterfaceError)))
+        if self.discard:
+            reusable = False
+        if self.cancelled or self.killed:
+            #A KILL QUERY may have arrived just after the statement finished, and would abort the next one
+            reusable = False
+        if (exc_type is not None) and (self.cursorclass is not None) and issubclass(self.cursorclass, MySQLdb.cursors.SSCursor):
+            #Closing an unbuffered cursor would first read all remaining rows; drop the connection instead
+            reusable = False
+        else:
+            self.cursor.close()
+        connectionPool.Release(self.db_args, self.db, reusable)
 
     def execute(self, query, params=None):
-        if 'read_timeout' not in self.db_args:
+        with self.lock:
+            if self.cancelled:
+                raise Cancelled()
+            self.executing = True
+        starttime = time.time()
+        rows = 0
+        try:
+            result = self._ExecuteWatched(query, params)
+            #Unbuffered cursors do not know the number of rows yet
+            if 0 <= self.cursor.rowcount < 2**62:
+                rows = self.cursor.rowcount
+            return result
+        except MySQLdb.Error:
+            if self.cancelled:
+                raise Cancelled()
+            raise
+        finally:
+            with self.lock:
+                self.executing = False
+            duration = time.time() - starttime
+            DQXMetrics.RecordSQL(duration, rows)
+            if slowQueryLog.IsSlow(duration):
+                slowQueryLog.Record(query, params, duration, rows, self.db_args)
+
+    def _ExecuteWatched(self, query, params):
+        if self.deadline is None:
             return self.cursor.execute(query, params)
-        else:
-            timeout = self.db_args['read_timeout']
-            t = time.time()
-            try:
-                return self.cursor.execute(query, params)
-            except MySQLdb.OperationalError as e:
-                if e[0] == 2013: #Check specific error code (Lost connection)
-                    #As the MYSQL API doesn't tell us this is a timeout or not we
-                    #guess based on the fact that the exception was raised just
-                    # when we expect it to be.... yeah I know.
-                    duration = (time.time() - t)
-                    #Re-connect and kill the query
-                    self.db = MySQLdb.connect(**self.db_args)
-                    self.cursor = self.db.cursor()
-                    self.cursor.execute("KILL %s", (self.conn_id,))
-                    #Give 50ms grace in either dir
-                    if (duration > timeout - 0.05) and (duration < timeout + 0.05):
-                        raise Timeout
-
-                raise e
+        if time.time() >= self.deadline:
+            raise Timeout()
+        entry = queryWatchdog.Watch(self.conn_id, self.deadline, self.db_args)
+        try:
+            return self.cursor.execute(query, params)
+        except MySQLdb.Error:
+            if queryWatchdog.Unwatch(entry):
+                raise Timeout()
+            raise
+        finally:
+            if queryWatchdog.Unwatch(entry):
+                self.killed = True
+
+    #Aborts the statement currently executed by this cursor (if any), and makes any further statement fail
+    #Can be called from another thread; the thread running the statement gets a Cancelled exception
+    def Cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            if self.executing:
+                queryWatchdog.KillNow(self.conn_id, self.db_args)
+
+    #Closes the connection when the cursor is done, rather than returning it to the pool
+    #(e.g. after changing session settings that should not affect later users of the connection)
+    def DiscardConnection(self):
+        self.discard = True
+
+    #Returns the remaining time budget of this cursor in seconds, or None if it has no deadline
+    def GetRemainingTime(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
 
     def commit(self):
         self.db.commit()
@@ -263,41 +672,112 @@ def ParseColumnEncoding(columnstr):
     return mycolumns
 
 
+#Clients send the same column lists over and over, so their decoded form is kept
+_columnListCache = DQXCache.LRUCache(maxCount=getattr(config, 'COLUMNLIST_CACHESIZE', 1000))
+
+#Decodes an lz-string compressed column list (e.g. the collist parameter) into a list of column encodings
+#(see ParseColumnEncoding). The caller receives its own copy, and is free to modify it
+def DecodeColumnList(encodedstr):
+    mycolumns = _columnListCache.Get(encodedstr)
+    if mycolumns is None:
+        mycolumns = ParseColumnEncoding(lzstring.decompressFromEncodedURIComponent(encodedstr))
+        _columnListCache.Set(encodedstr, mycolumns)
+    return [dict(col) for col in mycolumns]
+
+
+#Compiled where clauses, keyed by (encoded query, parameter placeholder)
+#Each entry holds the statement tree, the parametrised where clause string and the parameter values
+_compiledQueryCache = DQXCache.LRUCache(maxCount=getattr(config, 'WHERECLAUSE_CACHESIZE', 1000))
+
+
 #A whereclause encapsulates the where statement of a single table sql query
-class WhereClause:
+class WhereClause(object):
     def __init__(self):
-        self.query = None #this contains a tree of statements
+        self._query = None #this contains a tree of statements
+        self._encodedstr = None #the encoded form of the statement tree, if it was decoded from one
+        self._querystring = None
         self.ParameterPlaceHolder = "?" #determines what is the placeholder for a parameter to be put in an sql where clause string
 
+    @property
+    def query(self):
+        return self._query
+
+    @query.setter
+    def query(self, value):
+        self._query = value
+        self._encodedstr = None
+
     #Decodes an url compatible encoded query into the statement tree
     def Decode(self, encodedstr):
-        decodedstr = DQXbase64.b64decode_var2(encodedstr)
-        self.query = simplejson.loads(decodedstr)
-        pass
+        compiled = _compiledQueryCache.Get((encodedstr, self.ParameterPlaceHolder))
+        if compiled is not None:
+            self._query = compiled[0]
+        else:
+            decodedstr = DQXbase64.b64decode_var2(encodedstr)
+            self._query = simplejson.loads(decodedstr)
+        self._encodedstr = encodedstr
+
+    #Returns the names of all table columns referred to in the statement tree
+    def GetColumnNames(self):
+        names = []
+        self._GetColumnNamesSub(self.query, names)
+        return names
+
+    def _GetColumnNamesSub(self, statm, names):
+        if statm['Tpe'] in ['AND', 'OR']:
+            for comp in statm['Components']:
+                self._GetColumnNamesSub(comp, names)
+            return
+        for field in ['ColName', 'ColName2', 'PrimKey']:
+            if field in statm:
+                names.append(ToSafeIdentifier(statm[field]))
 
     #Creates an SQL where clause string out of the statement tree
     def CreateSelectStatement(self):
-        self.querystring = '' #will hold the fully filled in standalone where clause string (do not use this if sql injection is an issue!)
-        self.querystring_params = '' #will hold the parametrised where clause string
-        self.queryparams = [] #will hold a list of parameter values
-        self._CreateSelectStatementSub(self.query)
-
-    def _CreateSelectStatementSub_Compound(self, statm):
+        #querystring_params will hold the parametrised where clause string
+        #queryparams will hold a list of parameter values
+        self._querystring = None
+        cachekey = None
+        if self._encodedstr is not None:
+            cachekey = (self._encodedstr, self.ParameterPlaceHolder)
+            compiled = _compiledQueryCache.Get(cachekey)
+            if compiled is not None:
+                self.querystring_params = compiled[1]
+                self.queryparams = list(compiled[2])
+                return
+        parts = []
+        self.queryparams = []
+        self._CreateSelectStatementSub(self.query, parts, self.queryparams)
+        self.querystring_params = ''.join(parts)
+        if cachekey is not None:
+            _compiledQueryCache.Set(cachekey, (self.query, self.querystring_params, tuple(self.queryparams)))
+
+    #The fully filled in standalone where clause string (do not use this if sql injection is an issue!)
+    #Only generated when requested
+    @property
+    def querystring(self):
+        if self._querystring is None:
+            parts = []
+            self._CreateSelectStatementSub(self.query, parts, None)
+            self._querystring = ''.join(parts)
+        return self._querystring
+
+    #The statement generators below append the where clause string to parts
+    #If params is None, the standalone string is created; otherwise the parametrised string, and the parameter values are appended to params
+
+    def _CreateSelectStatementSub_Compound(self, statm, parts, params):
         if not(statm['Tpe'] in ['AND', 'OR']):
             raise Exception("Invalid compound statement {0}".format(statm['Tpe']))
         first = True
         for comp in statm['Components']:
             if not first:
-                self.querystring += " "+statm['Tpe']+" "
-                self.querystring_params += " "+statm['Tpe']+" "
-            self.querystring += "("
-            self.querystring_params += "("
-            self._CreateSelectStatementSub(comp)
-            self.querystring += ")"
-            self.querystring_params += ")"
+                parts.append(" "+statm['Tpe']+" ")
+            parts.append("(")
+            self._CreateSelectStatementSub(comp, parts, params)
+            parts.append(")")
             first = False
 
-    def _CreateSelectStatementSub_Comparison(self, statm):
+    def _CreateSelectStatementSub_Comparison(self, statm, parts, params):
         #TODO: check that statm['ColName'] corresponds to a valid column name in the table (to avoid SQL injection)
         if not(statm['Tpe'] in ['=', '<>', '<', '>', '<=', '>=', '!=', 'LIKE', 'CONTAINS', 'NOTCONTAINS', 'STARTSWITH', 'ISPRESENT', 'ISABSENT', '=FIELD', '<>FIELD', '<FIELD', '>FIELD', 'between', 'ISEMPTYSTR', 'ISNOTEMPTYSTR', '_subset_', '_note_']):
             raise Exception("Invalid comparison statement {0}".format(statm['Tpe']))
@@ -307,80 +787,70 @@ class WhereClause:
 
         if statm['Tpe'] == 'ISPRESENT':
             processed = True
-            st = '{0} IS NOT NULL'.format(DBCOLESC(statm['ColName']))
-            self.querystring += st
-            self.querystring_params += st
+            parts.append('{0} IS NOT NULL'.format(DBCOLESC(statm['ColName'])))
 
         if statm['Tpe'] == 'ISABSENT':
             processed = True
-            st = '{0} IS NULL'.format(DBCOLESC(statm['ColName']))
-            self.querystring += st
-            self.querystring_params += st
+            parts.append('{0} IS NULL'.format(DBCOLESC(statm['ColName'])))
 
         if statm['Tpe'] == 'ISEMPTYSTR':
             processed = True
-            st = '{0}=""'.format(DBCOLESC(statm['ColName']))
-            self.querystring += st
-            self.querystring_params += st
+            parts.append('{0}=""'.format(DBCOLESC(statm['ColName'])))
 
         if statm['Tpe'] == 'ISNOTEMPTYSTR':
             processed = True
-            st = '{0}<>""'.format(DBCOLESC(statm['ColName']))
-            self.querystring += st
-            self.querystring_params += st
+            parts.append('{0}<>""'.format(DBCOLESC(statm['ColName'])))
 
         if statm['Tpe'] == '=FIELD':
             processed = True
-            st = '{0}={1}'.format(
+            parts.append('{0}={1}'.format(
                 DBCOLESC(statm['ColName']),
                 DBCOLESC(statm['ColName2'])
-            )
-            self.querystring += st
-            self.querystring_params += st
+            ))
 
         if statm['Tpe'] == '<>FIELD':
             processed = True
-            st = '{0}<>{1}'.format(
+            parts.append('{0}<>{1}'.format(
                 DBCOLESC(statm['ColName']),
                 DBCOLESC(statm['ColName2'])
-            )
-            self.querystring += st
-            self.querystring_params += st
+            ))
 
         if (statm['Tpe'] == '<FIELD') or (statm['Tpe'] == '>FIELD'):
             processed = True
             operatorstr = statm['Tpe'].split('FIELD')[0]
-            self.querystring += '{0} {4} {1} * {2} + {3}'.format(
-                DBCOLESC(statm['ColName']),
-                ToSafeIdentifier(statm['Factor']),
-                DBCOLESC(statm['ColName2']),
-                ToSafeIdentifier(statm['Offset']),
-                operatorstr)
-            self.querystring_params += '{0} {4} {1} * {2} + {3}'.format(
-                DBCOLESC(statm['ColName']),
-                self.ParameterPlaceHolder,
-                DBCOLESC(statm['ColName2']),
-                self.ParameterPlaceHolder,
-                operatorstr)
-            self.queryparams.append(ToSafeIdentifier(statm['Factor']))
-            self.queryparams.append(ToSafeIdentifier(statm['Offset']))
+            if params is None:
+                parts.append('{0} {4} {1} * {2} + {3}'.format(
+                    DBCOLESC(statm['ColName']),
+                    ToSafeIdentifier(statm['Factor']),
+                    DBCOLESC(statm['ColName2']),
+                    ToSafeIdentifier(statm['Offset']),
+                    operatorstr))
+            else:
+                parts.append('{0} {4} {1} * {2} + {3}'.format(
+                    DBCOLESC(statm['ColName']),
+                    self.ParameterPlaceHolder,
+                    DBCOLESC(statm['ColName2']),
+                    self.ParameterPlaceHolder,
+                    operatorstr))
+                params.append(ToSafeIdentifier(statm['Factor']))
+                params.append(ToSafeIdentifier(statm['Offset']))
 
         if statm['Tpe'] == 'between':
             processed = True
-            self.querystring += DBCOLESC(statm['ColName'])+' between '+ToSafeIdentifier(statm["CompValueMin"])+' and '+ToSafeIdentifier(statm["CompValueMax"])
-            self.querystring_params += '{0} between {1} and {1}'.format(DBCOLESC(statm['ColName']), self.ParameterPlaceHolder)
-            self.queryparams.append(ToSafeIdentifier(statm["CompValueMin"]))
-            self.queryparams.append(ToSafeIdentifier(statm["CompValueMax"]))
+            if params is None:
+                parts.append(DBCOLESC(statm['ColName'])+' between '+ToSafeIdentifier(statm["CompValueMin"])+' and '+ToSafeIdentifier(statm["CompValueMax"]))
+            else:
+                parts.append('{0} between {1} and {1}'.format(DBCOLESC(statm['ColName']), self.ParameterPlaceHolder))
+                params.append(ToSafeIdentifier(statm["CompValueMin"]))
+                params.append(ToSafeIdentifier(statm["CompValueMax"]))
 
         if statm['Tpe'] == '_subset_':
             processed = True
-            querystr = '{primkey} IN (SELECT {primkey} FROM {subsettable} WHERE subsetid={subsetid})'.format(
+            parts.append('{primkey} IN (SELECT {primkey} FROM {subsettable} WHERE subsetid={subsetid})'.format(
                 primkey=DBCOLESC(ToSafeIdentifier(statm['PrimKey'])),
                 subsettable=DBTBESC(ToSafeIdentifier(statm['SubsetTable'])),
                 subsetid=ToSafeIdentifier(statm['Subset'])
-            )
-            self.querystring += querystr
-            self.querystring_params += querystr
+            ))
 
         if statm['Tpe'] == '_note_':
             processed = True
@@ -391,7 +861,8 @@ class WhereClause:
                 pass
             else:
                 whereclause = 'MATCH(`content`) AGAINST (__param__ IN BOOLEAN MODE)'
-                self.queryparams.append(param)
+                if params is not None:
+                    params.append(param)
 
             querystr = '{primkey} IN (SELECT `itemid` FROM `notes` WHERE (`tableid`="{tableid}") and ({whereclause}))'.format(
 #            querystr = '{primkey} IN (SELECT `itemid` FROM `notes` WHERE (`tableid`="{tableid}") and (`content` LIKE __param__))'.format(
@@ -399,8 +870,10 @@ class WhereClause:
                 tableid=ToSafeIdentifier(statm['NoteItemTable']),
                 primkey=DBCOLESC(ToSafeIdentifier(statm['PrimKey']))
             )
-            self.querystring += querystr.replace('__param__', '"' + param + '"')
-            self.querystring_params += querystr.replace('__param__', self.ParameterPlaceHolder)
+            if params is None:
+                parts.append(querystr.replace('__param__', '"' + param + '"'))
+            else:
+                parts.append(querystr.replace('__param__', self.ParameterPlaceHolder))
 
         if not(processed):
             decoval = statm['CompValue']
@@ -414,33 +887,33 @@ class WhereClause:
             if operatorstr == 'STARTSWITH':
                 operatorstr = 'LIKE'
                 decoval = '{0}%'.format(decoval)
-            self.querystring += DBCOLESC(statm['ColName']) + ' '+ToSafeIdentifier(operatorstr)+' '
-            self.querystring_params += '{0} {1} {2}'.format(
-                DBCOLESC(statm['ColName']),
-                ToSafeIdentifier(operatorstr),
-                self.ParameterPlaceHolder)
             needquotes = (type(decoval) is not float) and (type(decoval) is not int)
             if needquotes:
-                self.querystring += "'"
                 decoval = decoval.replace("'", "")
             else:
                 decoval = ToSafeIdentifier(decoval)
-            self.querystring += str(decoval)
-            if needquotes:
-                self.querystring += "'"
-            self.queryparams.append(decoval)
+            if params is None:
+                parts.append(DBCOLESC(statm['ColName']) + ' '+ToSafeIdentifier(operatorstr)+' ')
+                if needquotes:
+                    parts.append("'" + str(decoval) + "'")
+                else:
+                    parts.append(str(decoval))
+            else:
+                parts.append('{0} {1} {2}'.format(
+                    DBCOLESC(statm['ColName']),
+                    ToSafeIdentifier(operatorstr),
+                    self.ParameterPlaceHolder))
+                params.append(decoval)
 
-    def _CreateSelectStatementSub(self, statm):
+    def _CreateSelectStatementSub(self, statm, parts, params):
         if statm['Tpe'] == '':
             return #trivial query
-        self.querystring += "("
-        self.querystring_params += "("
+        parts.append("(")
         if (statm['Tpe'] == 'AND') or (statm['Tpe'] == 'OR'):
-            self._CreateSelectStatementSub_Compound(statm)
+            self._CreateSelectStatementSub_Compound(statm, parts, params)
         else:
-            self._CreateSelectStatementSub_Comparison(statm)
-        self.querystring += ")"
-        self.querystring_params += ")"
+            self._CreateSelectStatementSub_Comparison(statm, parts, params)
+        parts.append(")")
 
 
 
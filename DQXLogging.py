@@ -0,0 +1,151 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# Asynchronous server log (backend of DQXUtils.LogServer)
+# Records are put on a bounded queue, and written to stdout by a background thread, so that request threads never
+# wait for log I/O. If the queue is full, records are dropped (and counted) rather than blocking the caller
+# Each record is written as a line of key=value pairs, e.g.
+#   ts=2014-05-01T12:00:00.123Z req=5f0c2a91d3e4 cat=QRY msg="SELECT ..."
+# Records are tagged with the id of the request handled by the thread (see SetRequestId)
+# Categories can be sampled (config.LOG_SAMPLING, e.g. {'QRY': 0.01}). Sampling is decided per request,
+# so that all records of a sampled request are kept together
+
+import atexit
+import datetime
+import Queue
+import sys
+import threading
+import uuid
+import zlib
+
+import config
+
+
+_local = threading.local()
+
+
+def NewRequestId():
+    return uuid.uuid4().hex[:12]
+
+
+#Sets the id of the request handled by the current thread (None if the thread does not handle a request)
+def SetRequestId(requestId):
+    _local.requestId = requestId
+
+
+def GetRequestId():
+    return getattr(_local, 'requestId', None)
+
+
+#Returns the category of a record: the prefix of messages such as '###QRY:...', or 'general'
+def GetCategory(line):
+    if line.startswith('###'):
+        pos = line.find(':')
+        if pos > 3:
+            return line[3:pos]
+    return 'general'
+
+
+def _Quote(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r') + '"'
+
+
+class AsyncLogWriter(object):
+    def __init__(self, stream, queueSize, sampling):
+        self.stream = stream
+        self.sampling = sampling #maps category to the fraction of requests for which its records are kept
+        self.queue = Queue.Queue(maxsize=queueSize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+
+    #Returns True if records of this category are to be kept for a request
+    def IsSampled(self, category, requestId):
+        rate = self.sampling.get(category, 1.0)
+        if rate >= 1.0:
+            return True
+        if requestId is None:
+            return False
+        return (zlib.crc32(requestId) & 0xffffffff) < rate * 0x100000000
+
+    def Log(self, line, category=None, **fields):
+        if category is None:
+            category = GetCategory(line)
+        requestId = GetRequestId()
+        if not self.IsSampled(category, requestId):
+            return
+        if self.thread is None:
+            self._Start()
+        try:
+            self.queue.put_nowait((datetime.datetime.utcnow(), requestId, category, line, fields))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _Start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._Run, name='DQXLogWriter')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _Format(self, record):
+        timestamp, requestId, category, line, fields = record
+        items = [
+            'ts=' + timestamp.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}Z'.format(timestamp.microsecond // 1000),
+            'req=' + (requestId or '-'),
+            'cat=' + category,
+        ]
+        for key in sorted(fields):
+            items.append('{0}={1}'.format(key, _Quote(fields[key])))
+        items.append('msg=' + _Quote(line))
+        return ' '.join(items) + '\n'
+
+    def _Run(self):
+        stopping = False
+        while not stopping:
+            lines = []
+            record = self.queue.get()
+            #Write whatever else is waiting in one go
+            while True:
+                if record is None:
+                    stopping = True
+                    break
+                lines.append(self._Format(record))
+                if len(lines) >= 1000:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            if self.dropped > 0:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self._Format((datetime.datetime.utcnow(), None, 'log', '{0} records dropped'.format(dropped), {})))
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except Exception:
+                pass
+
+    #Writes the pending records, waiting at most timeout seconds
+    def Stop(self, timeout=5.0):
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+writer = AsyncLogWriter(sys.stdout, getattr(config, 'LOG_QUEUESIZE', 10000), getattr(config, 'LOG_SAMPLING', {}))
+
+atexit.register(writer.Stop)
+
+
+def Log(line, category=None, **fields):
+    writer.Log(line, category, **fields)
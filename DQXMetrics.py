@@ -0,0 +1,182 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# In-process metrics registry, recording per responder and per dataset:
+#  - request latency, SQL execution time and response encoding time (histograms)
+#  - rows returned by SQL statements, response bytes, errors and timeouts (counters)
+# Measurements of a request are collected in a RequestContext, which is attached to the thread handling it,
+# so that e.g. DBCursor can contribute without being passed the context explicitly
+# The registry is rendered in the Prometheus text exposition format by the metrics responder
+
+import threading
+import time
+
+import config
+
+
+# Upper bounds (in seconds) of the histogram buckets
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) #last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def Observe(self, value):
+        idx = 0
+        while (idx < len(self.buckets)) and (value > self.buckets[idx]):
+            idx += 1
+        self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Measurements of a single request, possibly contributed by several threads
+class RequestContext(object):
+    def __init__(self, responder, dataset):
+        self.responder = responder
+        self.dataset = dataset
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.sqlTime = 0.0
+        self.sqlRows = 0
+        self.encodeTime = 0.0
+        self.responseBytes = 0
+
+    def AddSQL(self, duration, rows):
+        with self.lock:
+            self.sqlTime += duration
+            self.sqlRows += rows
+
+    def AddEncoding(self, duration, size):
+        with self.lock:
+            self.encodeTime += duration
+            self.responseBytes += size
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {} #maps (responder, dataset) to a Histogram
+        self.sqlTime = {}
+        self.encodeTime = {}
+        self.rows = {}
+        self.responseBytes = {}
+        self.requests = {}
+        self.errors = {}
+        self.timeouts = {}
+
+    #Records a finished request. status is 'ok', 'error' or 'timeout'
+    def Record(self, context, status):
+        key = (context.responder, context.dataset)
+        duration = time.time() - context.startTime
+        with self.lock:
+            for histograms, value in [(self.latency, duration), (self.sqlTime, context.sqlTime), (self.encodeTime, context.encodeTime)]:
+                if key not in histograms:
+                    histograms[key] = Histogram(DURATION_BUCKETS)
+                histograms[key].Observe(value)
+            self.rows[key] = self.rows.get(key, 0) + context.sqlRows
+            self.responseBytes[key] = self.responseBytes.get(key, 0) + context.responseBytes
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if status == 'error':
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if status == 'timeout':
+                self.timeouts[key] = self.timeouts.get(key, 0) + 1
+
+    #Returns the content of the registry in the Prometheus text format
+    def Render(self):
+        lines = []
+        with self.lock:
+            self._RenderHistograms(lines, 'dqx_request_duration_seconds', 'Wall clock time of API requests', self.latency)
+            self._RenderHistograms(lines, 'dqx_sql_duration_seconds', 'Time spent executing SQL statements, per request', self.sqlTime)
+            self._RenderHistograms(lines, 'dqx_encode_duration_seconds', 'Time spent encoding responses, per request', self.encodeTime)
+            self._RenderCounters(lines, 'dqx_requests_total', 'Number of API requests', self.requests)
+            self._RenderCounters(lines, 'dqx_request_errors_total', 'Number of API requests that failed', self.errors)
+            self._RenderCounters(lines, 'dqx_request_timeouts_total', 'Number of API requests that exceeded their time budget', self.timeouts)
+            self._RenderCounters(lines, 'dqx_sql_rows_total', 'Number of rows returned by SQL statements', self.rows)
+            self._RenderCounters(lines, 'dqx_response_bytes_total', 'Size of the (uncompressed) API responses', self.responseBytes)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _Labels(key, extra=''):
+        labels = 'responder="{0}",dataset="{1}"'.format(_EscapeLabel(key[0]), _EscapeLabel(key[1]))
+        if extra:
+            labels += ',' + extra
+        return '{' + labels + '}'
+
+    def _RenderHistograms(self, lines, name, description, histograms):
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, self._Labels(key, 'le="{0}"'.format(bound)), cumulative))
+            lines.append('{0}_sum{1} {2!r}'.format(name, self._Labels(key), histogram.sum))
+            lines.append('{0}_count{1} {2}'.format(name, self._Labels(key), histogram.count))
+
+    def _RenderCounters(self, lines, name, description, counters):
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} counter'.format(name))
+        for key in sorted(counters):
+            lines.append('{0}{1} {2}'.format(name, self._Labels(key), counters[key]))
+
+
+def _EscapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+_local = threading.local()
+
+
+#Returns the label under which a request for a dataset is recorded
+#The dataset is provided by the client: anything that is not a known dataset is recorded as 'other',
+#so that the number of series stays bounded
+def DatasetLabel(dataset):
+    if (not dataset) or (dataset == getattr(config, 'DB', '')):
+        return getattr(config, 'DB', '')
+    import DQXDbMetadata #imported here, as DQXDbMetadata depends on this module (through DQXDbTools)
+    try:
+        if dataset in DQXDbMetadata.GetDatasets():
+            return dataset
+    except Exception:
+        pass
+    return 'other'
+
+
+#Starts collecting the measurements of a request handled by the current thread
+def BeginRequest(responder, dataset=None):
+    context = RequestContext(responder, DatasetLabel(dataset))
+    _local.context = context
+    return context
+
+
+#Records the measurements of a request, and detaches it from the current thread
+def EndRequest(context, status):
+    registry.Record(context, status)
+    if getattr(_local, 'context', None) is context:
+        _local.context = None
+
+
+#Returns the context of the request handled by the current thread, or None
+def GetContext():
+    return getattr(_local, 'context', None)
+
+
+#Attaches a request context to the current thread (e.g. a worker thread executing part of a request)
+def SetContext(context):
+    _local.context = context
+
+
+#Adds the execution of an SQL statement to the current request (if any)
+def RecordSQL(duration, rows):
+    context = getattr(_local, 'context', None)
+    if context is not None:
+        context.AddSQL(duration, rows)
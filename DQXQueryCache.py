@@ -0,0 +1,128 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# Caches the results of table queries, so that identical requests (e.g. paging back and forth, or several users
+# opening the same view) do not rerun the same SQL
+# Keys are built from a canonical description of the query, together with the version of the table:
+#  - its CREATE_TIME & UPDATE_TIME, as reported by DQXDbMetadata
+#  - a generation number that is incremented by InvalidateTable
+# A modified table therefore never matches older entries, which simply age out of the LRU
+# Writes done by this server call InvalidateTable, and are visible immediately. Writes done by other processes are
+# only detected once the table metadata is revalidated, i.e. after at most METADATA_TTL seconds
+# Tables for which MySQL reports no UPDATE_TIME (e.g. InnoDB before 5.7, or after a server restart) are not cached,
+# unless RESULTCACHE_UNVERSIONEDTABLES is set (in which case changes are only seen when entries expire)
+# A key of None means that the query is not to be cached; the functions below accept it
+# Record counts are kept in a separate cache, keyed by table and where clause only, so that they are shared
+# between all pages of a pageqry view and getrecordcount
+
+import threading
+import simplejson
+
+import config
+import DQXCache
+import DQXDbMetadata
+
+
+resultCache = DQXCache.LRUCache(
+    maxCount=getattr(config, 'RESULTCACHE_MAXENTRIES', 10000),
+    maxBytes=getattr(config, 'RESULTCACHE_MAXBYTES', 64 * 1024 * 1024),
+    ttl=getattr(config, 'RESULTCACHE_TTL', 600)
+)
+
+countCache = DQXCache.LRUCache(
+    maxCount=getattr(config, 'COUNTCACHE_MAXENTRIES', 20000),
+    maxBytes=getattr(config, 'COUNTCACHE_MAXBYTES', 16 * 1024 * 1024),
+    ttl=getattr(config, 'COUNTCACHE_TTL', getattr(config, 'RESULTCACHE_TTL', 600))
+)
+
+_generationLock = threading.Lock()
+_generations = {}
+
+
+#Returns a canonical form of a decoded WhereClause statement tree
+#The components of AND & OR statements are put in a fixed order, as their order does not affect the result
+def CanonicalQuery(statm):
+    if (statm is not None) and (statm.get('Tpe') in ['AND', 'OR']):
+        components = sorted([CanonicalQuery(comp) for comp in statm['Components']], key=lambda comp: simplejson.dumps(comp, sort_keys=True))
+        return {'Tpe': statm['Tpe'], 'Components': components}
+    return statm
+
+
+#Marks all cached results of a table as outdated (to be called after modifying the table)
+def InvalidateTable(databaseName, tableName):
+    with _generationLock:
+        _generations[(databaseName, tableName)] = _generations.get((databaseName, tableName), 0) + 1
+    DQXDbMetadata.InvalidateTable(databaseName, tableName)
+
+
+#Returns the version of a table, or None if it is unknown
+def _GetTableVersion(cur, databaseName, tableName):
+    with _generationLock:
+        generation = _generations.get((databaseName, tableName), 0)
+    info = DQXDbMetadata.GetTableInfo(cur, tableName, databaseName)
+    if (info is None) or (info.updateTime is None):
+        if not getattr(config, 'RESULTCACHE_UNVERSIONEDTABLES', False):
+            return None
+        if info is None:
+            return [generation]
+    return [generation, str(info.createTime), str(info.updateTime)]
+
+
+#Creates the cache key for a query of kind (e.g. the responder name) on a table, or None if it can not be cached
+#whc is the (decoded) DQXDbTools.WhereClause; parts is a dictionary with all other parameters that affect the result
+def CreateKey(cur, kind, tableName, whc, parts):
+    databaseName = cur.db_args['db']
+    version = _GetTableVersion(cur, databaseName, tableName)
+    if version is None:
+        return None
+    return simplejson.dumps([
+        kind,
+        databaseName,
+        tableName,
+        version,
+        CanonicalQuery(whc.query),
+        parts
+    ], sort_keys=True)
+
+
+def Get(key):
+    if key is None:
+        return None
+    return resultCache.Get(key)
+
+
+def Set(key, result):
+    if key is not None:
+        resultCache.Set(key, result)
+
+
+#Creates the cache key for the number of records of a table that match a where clause
+def CreateCountKey(cur, tableName, whc):
+    return CreateKey(cur, 'count', tableName, whc, None)
+
+
+#Returns a (count, exact) tuple, or None if nothing is known
+#If exact is False, count is a lower bound of the number of records (obtained from a capped count)
+def GetCount(key):
+    if key is None:
+        return None
+    return countCache.Get(key)
+
+
+def SetCount(key, count, exact):
+    if key is None:
+        return
+    if not exact:
+        known = countCache.Get(key)
+        if (known is not None) and (known[1] or (known[0] >= count)):
+            return
+    countCache.Set(key, (count, exact))
+
+
+def GetStatistics():
+    return resultCache.GetStatistics()
+
+
+def GetCountStatistics():
+    return countCache.GetStatistics()
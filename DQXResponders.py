@@ -0,0 +1,103 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# Registry resolving request types to responder modules
+# The available responders are listed once: the modules in responders/, and the packages in customresponders/
+# (custom responders are identified as 'custom.<package>.<module>'). Modules are imported on first use, and kept
+# Startup behaviour is controlled by:
+#  - config.RESPONDER_LAZY: if False (default), all custom responder packages are imported at startup, as they may
+#    perform initialisation (e.g. install a DQXDbTools.DbCredentialVerifier)
+#  - config.RESPONDER_PRELOAD: list of responders imported at startup, so that the first request is not slowed down
+# The time taken by each import is recorded, and can be obtained with GetImportTimes
+
+import importlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import DQXUtils
+import config
+import responders
+
+
+class ResponderRegistry(object):
+    def __init__(self, basePath):
+        self.lock = threading.RLock()
+        self.modules = {} #maps responder name to imported module
+        self.importTimes = OrderedDict() #maps module name to import time (in seconds), in order of import
+        self.builtin = set()
+        respondersPath = os.path.join(basePath, 'responders')
+        for filename in os.listdir(respondersPath):
+            name, ext = os.path.splitext(filename)
+            if (ext == '.py') and (name != '__init__'):
+                self.builtin.add(name)
+        self.customPackages = set()
+        self.customPath = os.path.join(basePath, 'customresponders')
+        if os.path.isdir(self.customPath):
+            for dirname in os.listdir(self.customPath):
+                if os.path.isdir(os.path.join(self.customPath, dirname)) and DQXUtils.identifierMatcher.match(dirname):
+                    self.customPackages.add(dirname)
+
+    def _Import(self, name, moduleName):
+        with self.lock:
+            module = self.modules.get(name)
+            if module is None:
+                starttime = time.time()
+                module = importlib.import_module(moduleName)
+                self.importTimes[moduleName] = time.time() - starttime
+                self.modules[name] = module
+            return module
+
+    #Returns the module of a built in responder
+    def Get(self, requestType):
+        module = self.modules.get(requestType)
+        if module is not None:
+            return module
+        if requestType not in self.builtin:
+            raise Exception("Unknown request {0}".format(requestType))
+        #Note: the responders package is replaced by a wrapper, its original is registered as respondersraw
+        return self._Import(requestType, 'respondersraw.' + requestType)
+
+    #Returns the module of a custom responder
+    def GetCustom(self, packageName, responderId):
+        name = 'custom.' + packageName + '.' + responderId
+        module = self.modules.get(name)
+        if module is not None:
+            return module
+        if (packageName not in self.customPackages) or (not DQXUtils.identifierMatcher.match(responderId)):
+            raise Exception("Unknown custom request {0}.{1}".format(packageName, responderId))
+        return self._Import(name, 'customresponders.' + packageName + '.' + responderId)
+
+    #Returns a responder identified by 'name' or 'custom.<package>.<module>'
+    def GetByName(self, name):
+        if name.startswith('custom.'):
+            parts = name.split('.')
+            if len(parts) != 3:
+                raise Exception("Invalid custom responder name {0}".format(name))
+            return self.GetCustom(parts[1], parts[2])
+        return self.Get(name)
+
+    def ImportCustomPackages(self):
+        for packageName in sorted(self.customPackages):
+            self._Import('customresponders.' + packageName, 'customresponders.' + packageName)
+
+    def Preload(self, names):
+        for name in names:
+            self.GetByName(name)
+
+    def GetImportTimes(self):
+        with self.lock:
+            return OrderedDict(self.importTimes)
+
+
+registry = ResponderRegistry(os.path.dirname(os.path.realpath(__file__)))
+
+
+def Initialise():
+    if not getattr(config, 'RESPONDER_LAZY', False):
+        registry.ImportCustomPackages()
+    registry.Preload(getattr(config, 'RESPONDER_PRELOAD', []))
+    for moduleName, duration in registry.GetImportTimes().items():
+        DQXUtils.LogServer('Imported {0} in {1}s'.format(moduleName, duration), 'STARTUP', module=moduleName, seconds=duration)
@@ -5,20 +5,29 @@
 import time
 import os
 import re
+import DQXLogging
 
 
-def LogServer(line):
-    print('@@@'+line)
+#Writes a line to the server log. This does not wait for the actual output (see DQXLogging)
+#The category is taken from a '###CATEGORY:' prefix if not specified
+def LogServer(line, category=None, **fields):
+    DQXLogging.Log(line, category, **fields)
+
+
+#Returns the processor time (user + system) used by the process, in seconds
+def ProcessTime():
+    times = os.times()
+    return times[0] + times[1]
 
 
 class Timer:
     def __init__(self):
         self.t0=time.time()
-        self.t1=time.clock()
+        self.t1=ProcessTime()
     def Elapsed(self):
         return time.time()-self.t0
     def ElapsedCPU(self):
-        return time.clock()-self.t1
+        return ProcessTime()-self.t1
 
 
 def GetDQXServerPath():
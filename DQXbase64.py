@@ -30,14 +30,21 @@ __all__ = [
     ]
 
 _translation = [chr(_x) for _x in range(256)]
+_translationTables = {}
 EMPTYSTRING = ''
 
 
 def _translate(s, altchars):
-    translation = _translation[:]
-    for k, v in altchars.items():
-        translation[ord(k)] = v
-    return s.translate(''.join(translation))
+    # Translation tables only depend on altchars, and are built once
+    key = tuple(sorted(altchars.items()))
+    table = _translationTables.get(key)
+    if table is None:
+        translation = _translation[:]
+        for k, v in altchars.items():
+            translation[ord(k)] = v
+        table = ''.join(translation)
+        _translationTables[key] = table
+    return s.translate(table)
 
 
 
@@ -8,6 +8,7 @@ import DQXMathUtils
 import os
 import re
 import DQXEncoder
+import DQXUtils
 import random
 import simplejson
 import math
@@ -196,7 +197,7 @@ class DataProperty:
 
 def ReadJsonFile(filename):
     if not os.path.isfile(filename):
-        print('ERROR: MISSING FILE '+filename)
+        DQXUtils.LogServer('ERROR: MISSING FILE '+filename)
         return None
     f = open(filename, 'r')
     body=''
@@ -250,9 +251,9 @@ class Creator:
         self.folder=ifolder
         self.config=iconfig
         self.datadir=self.basedir+'/'+self.folder
-        print('Initialising Creator, directory="{0}", config="{1}"'.format(self.datadir,self.config))
+        DQXUtils.LogServer('Initialising Creator, directory="{0}", config="{1}"'.format(self.datadir,self.config))
         configfilename = self.datadir+'/'+self.config+".cnf"
-        print('config filename= ' + configfilename)
+        DQXUtils.LogServer('config filename= ' + configfilename)
         configdata=ReadJsonFile(configfilename)
         if configdata is None:
             self.present = False
@@ -375,7 +376,7 @@ class Creator:
         filename=outputbasefilename+'_'+str(blockSize)
         #print('Fetching from '+filename)
         if not os.path.isfile(filename):
-            print('ERROR: MISSING FILE '+filename)
+            DQXUtils.LogServer('ERROR: MISSING FILE '+filename)
             return result
         f=open(filename,'r')
         f.seek(start*self.encodedRowSize)
@@ -8,6 +8,9 @@ from operator import mul
 
 NATIVE_ENDIAN = '<' if (np.dtype("<i").byteorder == '=') else '>'
 
+#Size of the pieces in which array data is yielded
+CHUNK_BYTES = 1024 * 1024
+
 def _strict_dtype_string(dtype):
     if dtype.str[1] == 'S' or dtype.str[1] == 'U':
         return 'S'
@@ -23,28 +26,67 @@ def _strict_dtype_string(dtype):
 
 #Convert a string array to a chain of null terminated strings
 def pack_string_array(array):
-    result = ''
-    if len(array) > 0:
-        for string in np.nditer(array):
-            result += str(string)
-            result += chr(0)
-    return result
+    array = np.ascontiguousarray(array, dtype='S').ravel()
+    if len(array) == 0:
+        return ''
+    #Each string occupies a fixed width row; its characters and the null following them are kept
+    lengths = np.char.str_len(array)
+    width = array.dtype.itemsize
+    chars = np.zeros((len(array), width + 1), dtype=np.uint8)
+    chars[:, :width] = array.view(np.uint8).reshape(len(array), width)
+    return chars[np.arange(width + 1) <= lengths[:, np.newaxis]].tostring()
+
+def _chunks(data):
+    """Split a string or buffer in pieces of at most CHUNK_BYTES, returned as strings"""
+    for start in range(0, len(data), CHUNK_BYTES):
+        yield data[start:start + CHUNK_BYTES]
 
 def _encode_numpy_array(array):
     dtype = _strict_dtype_string(array.dtype)
-    for char in dtype:
-        yield char
-    yield chr(0)
-    yield struct.pack('<B', len(array.shape))
-    for dim in array.shape:
-        yield struct.pack('<L', dim)
     if dtype == 'S':
         data = pack_string_array(array)
     else:
-        data = array.data
-    yield struct.pack('<L', reduce(mul,array.shape))
-    for byte in data:
-        yield byte
+        data = np.ascontiguousarray(array).data
+    header = [dtype, chr(0), struct.pack('<B', len(array.shape))]
+    for dim in array.shape:
+        header.append(struct.pack('<L', dim))
+    header.append(struct.pack('<L', reduce(mul, array.shape, 1)))
+    yield ''.join(header)
+    for chunk in _chunks(data):
+        yield chunk
+
+def _to_bytes(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def typed_array(values, encoding):
+    """Convert a list of column values to a typed numpy array
+
+    encoding is a DQX column encoding identifier (see B64.ValueListCoder.EncodeByMethod):
+    - 'ST', 'GN': null terminated strings, absent values become empty strings
+    - 'IN', 'IB', 'ID': 32 bit integers, or 64 bit floats if absent or out of range values are present
+    - other (float) encodings: 64 bit floats
+    For float arrays, absent values are represented as NaN.
+
+    """
+    if encoding in ('ST', 'GN'):
+        return np.array([_to_bytes(value) for value in values], dtype='S')
+    array = np.array(values, dtype='<f8')
+    if encoding in ('IN', 'IB', 'ID'):
+        if len(array) == 0:
+            return array.astype('<i4')
+        if np.all(np.isfinite(array)) and np.all(array == np.floor(array)) and (array.min() >= -2**31) and (array.max() < 2**31):
+            return array.astype('<i4')
+    return array
+
+def scalar_array(value):
+    """Wrap a single number or string in a one element array, so that it can be sent in an array set"""
+    if isinstance(value, basestring):
+        return np.array([_to_bytes(value)], dtype='S')
+    return np.array([value], dtype='<f8')
 
 def encode_array(array, dtype=None):
     """Encode an array for a JS arraybuffer
@@ -52,7 +94,7 @@ def encode_array(array, dtype=None):
     array can be any iterable or a numpy array. If it is not a numpy array it will be converted to one
     with the specifed dtype.
 
-    Returns a generator which yields bytes in the format:
+    Returns a generator which yields strings (header pieces and chunks of the data) in the format:
 
     - First two bytes are 'AB'
     - A /0 terminated cstyle string which is a valid numpy dtype, but which always includes the
@@ -69,17 +111,16 @@ def encode_array(array, dtype=None):
     except AttributeError:
         raise Exception("Non-numpy array passed, but with no numpy dtype to convert to")
     dtype = np.dtype(dtype)
-    yield 'A'
-    yield 'B'
-    for byte in _encode_numpy_array(np.asarray(array, dtype)):
-        yield byte
+    yield 'AB'
+    for chunk in _encode_numpy_array(np.asarray(array, dtype)):
+        yield chunk
 	
 def encode_array_set(array_set):
     """Encode a set of named arrays for a set of JS arraybuffer
 
     array_set is an iterable of name, numpy_array tuples.
 
-    Returns a generator which yields bytes in the format:
+    Returns a generator which yields strings (header pieces and chunks of the data) in the format:
 
     - First two bytes are 'AS'
     - 1-byte unsigned little endian number of arrays
@@ -94,15 +135,11 @@ def encode_array_set(array_set):
 
     """
     array_set = list(array_set)
-    yield 'A'
-    yield 'S'
-    yield struct.pack('<B', len(array_set))
+    yield 'AS' + struct.pack('<B', len(array_set))
     for name, array in array_set:
-        for char in name:
-            yield char
-        yield chr(0)
-        for byte in _encode_numpy_array(array):
-            yield byte
+        yield _to_bytes(name) + chr(0)
+        for chunk in _encode_numpy_array(array):
+            yield chunk
 
 	
 		
@@ -1,170 +1,102 @@
-from collections import namedtuple
-import math
-
 _keyStrUriSafe = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789~-$"
-_baseReverseDic = {}
 
 
-def _getBaseValue(alphabet, character):
-    try:
-        _baseReverseDic[alphabet]
-    except KeyError:
-        _baseReverseDic[alphabet] = {}
-        for i in xrange(len(alphabet)):
-            _baseReverseDic[alphabet][alphabet[i]] = i
-    return _baseReverseDic[alphabet][character]
+def _reversedBits(value, bitCount):
+    result = 0
+    for i in xrange(bitCount):
+        result = (result << 1) | ((value >> i) & 1)
+    return result
+
+# Maps each character of the alphabet to its value, with the bit order reversed
+# so that the compressed stream can be consumed least significant bit first
+_uriSafeValues = dict((character, _reversedBits(i, 6)) for i, character in enumerate(_keyStrUriSafe))
 
 def decompressFromEncodedURIComponent(input):
     if input is None:
         return ""
     if input == "":
         return ""
-    return _decompress(len(input), 32, lambda index: _getBaseValue(_keyStrUriSafe, input[index]))
+    return _decompress([_uriSafeValues[ch] for ch in input], 6)
 
 def decompress(compressed):
     if compressed is None:
         return ""
     if compressed == "":
         return ""
-    return _decompress(compressed.length, 32768, lambda index: compressed[index])
-
-def _decompress(length, resetValue, getNextValue):
-    dictionary = [False]*256*256
+    return _decompress([_reversedBits(ord(ch), 16) for ch in compressed], 16)
+
+
+# Reads the compressed stream from a list of bit-reversed values of bitsPerValue bits each
+class _BitReader(object):
+    __slots__ = ['values', 'bitsPerValue', 'index', 'buffer', 'bufferBits']
+
+    def __init__(self, values, bitsPerValue):
+        self.values = values
+        self.bitsPerValue = bitsPerValue
+        self.index = 0
+        self.buffer = 0
+        self.bufferBits = 0
+
+    # Returns the next bitCount bits as an integer, first bit of the stream as least significant bit
+    def read(self, bitCount):
+        buffer = self.buffer
+        bufferBits = self.bufferBits
+        while bufferBits < bitCount:
+            buffer |= self.values[self.index] << bufferBits
+            bufferBits += self.bitsPerValue
+            self.index += 1
+        self.buffer = buffer >> bitCount
+        self.bufferBits = bufferBits - bitCount
+        return buffer & ((1 << bitCount) - 1)
+
+
+def _decompress(values, bitsPerValue):
+    data = _BitReader(values, bitsPerValue)
+    dictionary = [0, 1, 2]
     enlargeIn = 4
-    dictSize = 4
     numBits = 3
-    entry = ""
-    result = ""
-
-    class Data:
-        pass
-    data = Data()
-    data.val = getNextValue(0)
-    data.position = resetValue
-    data.index = 1
-
-    for i in range(3):
-        dictionary[i] = i
 
-    bits = 0
-    maxpower = math.pow(2, 2)
-    power = 1
-    while power != maxpower:
-        resb = data.val & data.position
-        data.position >>= 1
-        if data.position == 0:
-            data.position = resetValue
-            data.val = getNextValue(data.index)
-            data.index += 1
-        bits |= (1 if resb > 0 else 0) * power
-        power <<= 1
-
-    next = bits
+    next = data.read(2)
     if next == 0:
-        bits = 0
-        maxpower = math.pow(2, 8)
-        power = 1
-        while power != maxpower:
-            resb = data.val & data.position
-            data.position >>= 1
-            if data.position == 0:
-                data.position = resetValue
-                data.val = getNextValue(data.index)
-                data.index += 1
-
-            bits |= (1 if resb > 0 else 0) * power
-            power <<= 1
-        c = unichr(bits)
+        c = unichr(data.read(8))
     elif next == 1:
-        bits = 0
-        maxpower = math.pow(2, 16)
-        power = 1
-        while power != maxpower:
-            resb = data.val & data.position
-            data.position >>= 1
-            if data.position == 0:
-                data.position = resetValue
-                data.val = getNextValue(data.index)
-                data.index += 1
-
-            bits |= (1 if resb > 0 else 0) * power
-            power <<= 1
-        c = unichr(bits)
+        c = unichr(data.read(16))
     elif next == 2:
         return ""
-    dictionary[3] = c
-    w = result = c
+    else:
+        return None
+    dictionary.append(c)
+    w = c
+    result = [c]
     while True:
-        if data.index > length:
-          return ""
-        bits = 0
-        maxpower = math.pow(2, numBits)
-        power = 1
-        while power != maxpower:
-            resb = data.val & data.position
-            data.position >>= 1
-            if data.position == 0:
-                data.position = resetValue
-                data.val = getNextValue(data.index)
-                data.index += 1
-            bits |= (1 if resb > 0 else 0) * power
-            power <<= 1
-        c = bits
+        c = data.read(numBits)
         if c == 0:
-            bits = 0
-            maxpower = math.pow(2, 8)
-            power = 1
-            while power != maxpower:
-                resb = data.val & data.position
-                data.position >>= 1
-                if data.position == 0:
-                    data.position = resetValue
-                    data.val = getNextValue(data.index)
-                    data.index += 1
-                bits |= (1 if resb > 0 else 0) * power
-                power <<= 1
-
-            dictionary[dictSize] = unichr(bits)
-            dictSize += 1
-            c = dictSize-1
+            dictionary.append(unichr(data.read(8)))
+            c = len(dictionary) - 1
             enlargeIn -= 1
         elif c == 1:
-            bits = 0
-            maxpower = math.pow(2, 16)
-            power = 1
-            while power != maxpower:
-                resb = data.val & data.position
-                data.position >>= 1
-                if data.position == 0:
-                    data.position = resetValue
-                    data.val = getNextValue(data.index)
-                    data.index += 1
-                bits |= (1 if resb > 0 else 0) * power
-                power <<= 1
-            dictionary[dictSize] = unichr(bits)
-            dictSize += 1
-            c = dictSize-1
+            dictionary.append(unichr(data.read(16)))
+            c = len(dictionary) - 1
             enlargeIn -= 1
         elif c == 2:
-            return result
+            return u''.join(result)
         if enlargeIn == 0:
-            enlargeIn = math.pow(2, numBits)
+            enlargeIn = 1 << numBits
             numBits += 1
 
-        if dictionary[c]:
+        if c < len(dictionary):
             entry = dictionary[c]
-        elif c == dictSize:
+        elif c == len(dictionary):
             entry = w + w[0]
         else:
-          return None
+            return None
 
-        result += entry
+        result.append(entry)
 
         # Add w+entry[0] to the dictionary.
-        dictionary[dictSize] = w + entry[0]
-        dictSize += 1
+        dictionary.append(w + entry[0])
         enlargeIn -= 1
         w = entry
         if enlargeIn == 0:
-          enlargeIn = math.pow(2, numBits)
-          numBits += 1
+            enlargeIn = 1 << numBits
+            numBits += 1
@@ -41,7 +41,7 @@ def response(returndata):
     hasSubFeatures = (returndata['subfeatures']=='1') and ('fsubtype' in returndata)
 
 
-    with DQXDbTools.DBCursor(returndata, databaseName, read_timeout=config.TIMEOUT) as cur:
+    with DQXDbTools.DBCursor(returndata, databaseName, timeout=DQXDbTools.GetResponderTimeout('annot')) as cur:
         tablename=DQXDbTools.ToSafeIdentifier(returndata['table'])
 
         typequerystring='(true)'
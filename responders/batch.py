@@ -0,0 +1,143 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# Executes a list of responder calls in one round trip, e.g. the burst of requests fired when a view opens
+# The sub-requests are provided as a JSON list of parameter dictionaries (each containing a 'datatype'),
+# either in the POST body or in the 'requests' parameter
+# They run concurrently on a bounded thread pool (sharing the pooled database connections), and the response
+# contains, in the same order, for each sub-request:
+#   - Status: 'OK', 'Error', 'CredentialError' or 'Timeout'
+#   - Time: wall clock time in seconds
+#   - Response: the response of the responder (if successful)
+#   - Error: description of the problem (if not successful)
+
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+import simplejson
+
+import DQXDbTools
+import DQXLogging
+import DQXMetrics
+import DQXResponders
+import DQXUtils
+import config
+
+# Responders that can not be part of a batch: those streaming a custom response, or reading the request body
+EXCLUDED = ['batch', 'downloadtable', 'storedata', 'storedatalong', 'uploadfile']
+
+_poolLock = threading.Lock()
+_pool = None
+
+
+#The thread pool is shared by all batch requests, so that the total number of threads stays bounded
+def _GetPool():
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(config, 'BATCH_THREADS', 8))
+        return _pool
+
+
+#Returns the responder of a sub-request, and its name in the metrics
+def _GetResponder(request_data):
+    request_type = request_data['datatype']
+    if request_type in EXCLUDED:
+        raise Exception('Request {0} is not supported in a batch'.format(request_type))
+    if request_type == 'custom':
+        responder = DQXResponders.registry.GetCustom(request_data['respmodule'], request_data['respid'])
+        metricsName = 'custom.' + request_data['respmodule'] + '.' + request_data['respid']
+    else:
+        responder = DQXResponders.registry.Get(request_type)
+        metricsName = request_type
+    if 'handler' in dir(responder):
+        raise Exception('Request {0} is not supported in a batch'.format(request_type))
+    return responder, metricsName
+
+
+def _Execute(item):
+    request_data, requestId = item
+    DQXLogging.SetRequestId(requestId)
+    try:
+        return _ExecuteItem(request_data)
+    finally:
+        #Worker threads are reused for other items and requests
+        DQXLogging.SetRequestId(None)
+
+
+def _ExecuteItem(request_data):
+    result = {}
+    tm = DQXUtils.Timer()
+    #Sub-requests that do not resolve to a valid responder are recorded under a fixed name,
+    #so that clients cannot create arbitrary metrics series
+    try:
+        responder, metricsName = _GetResponder(request_data)
+        error = None
+    except Exception as e:
+        responder, metricsName = None, 'invalid'
+        error = e
+    metricsContext = DQXMetrics.BeginRequest(metricsName, request_data.get('database', None))
+    status = 'error'
+    try:
+        if error is not None:
+            raise error
+        if request_data.get('format', None) == 'arraybuffer':
+            raise Exception('Binary responses are not supported in a batch')
+        response = responder.response(request_data)
+        if 'ArrayBuffer' in response:
+            raise Exception('Binary responses are not supported in a batch')
+        response.pop('environ', None)
+        result['Status'] = 'OK'
+        result['Response'] = response
+        status = 'ok'
+    except DQXDbTools.CredentialException as e:
+        result['Status'] = 'CredentialError'
+        result['Error'] = 'Credential problem: ' + str(e)
+    except DQXDbTools.Timeout:
+        result['Status'] = 'Timeout'
+        result['Error'] = 'Timeout'
+        status = 'timeout'
+    except Exception as e:
+        traceback.print_exc()
+        result['Status'] = 'Error'
+        result['Error'] = str(e)
+    result['Time'] = tm.Elapsed()
+    DQXMetrics.EndRequest(metricsContext, status)
+    DQXUtils.LogServer('Batch item {0} finished in {1}s'.format(request_data['datatype'], result['Time']), 'RESPONSE', status=result['Status'])
+    return result
+
+
+#Converts a JSON sub-request to a parameter dictionary, as it would be obtained from a query string
+def _ParseRequest(item, environ):
+    if (not isinstance(item, dict)) or ('datatype' not in item):
+        raise Exception('Invalid batch item: a dictionary containing a datatype is required')
+    request_data = {}
+    for key, value in item.items():
+        if not isinstance(value, basestring):
+            value = simplejson.dumps(value)
+        request_data[str(key)] = value
+    request_data['environ'] = environ
+    return request_data
+
+
+def response(returndata):
+    environ = returndata['environ']
+    if 'requests' in returndata:
+        content = returndata['requests']
+    else:
+        request_body_size = int(environ.get('CONTENT_LENGTH') or 0)
+        content = environ['wsgi.input'].read(request_body_size)
+    items = simplejson.loads(content)
+    if not isinstance(items, list):
+        raise Exception('Invalid batch: a list of requests is required')
+    maxitems = getattr(config, 'BATCH_MAXITEMS', 50)
+    if len(items) > maxitems:
+        raise Exception('Too many requests in batch ({0}, maximum {1})'.format(len(items), maxitems))
+
+    #Sub-requests are logged with the id of the batch, followed by their index
+    requestId = DQXLogging.GetRequestId() or DQXLogging.NewRequestId()
+    request_list = [(_ParseRequest(item, environ), '{0}.{1}'.format(requestId, nr)) for nr, item in enumerate(items)]
+    returndata['Results'] = _GetPool().map(_Execute, request_list, chunksize=1)
+    returndata.pop('requests', None)
+    return returndata
@@ -2,11 +2,15 @@
 # This program is free software licensed under the GNU Affero General Public License.
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
+import MySQLdb.cursors
 import DQXDbTools
 from DQXDbTools import DBCOLESC
 from DQXDbTools import DBTBESC
 import config
-import lzstring
+
+#Rows are read from MySQL in batches of this size, and sent to the client in chunks of about this many bytes
+FETCH_BATCH_ROWS = 1000
+OUTPUT_CHUNK_BYTES = 64 * 1024
 
 
 def response(returndata):
@@ -15,12 +19,13 @@ def response(returndata):
     myorderfield=returndata['order']
     sortreverse=int(returndata['sortreverse'])>0
 
-    mycolumns=DQXDbTools.ParseColumnEncoding(lzstring.decompressFromEncodedURIComponent(returndata['collist']))
+    mycolumns=DQXDbTools.DecodeColumnList(returndata['collist'])
 
     databaseName=None
     if 'database' in returndata:
         databaseName = returndata['database']
-    with DQXDbTools.DBCursor(returndata, databaseName, read_timeout=config.TIMEOUT) as cur:
+    #An unbuffered server-side cursor streams the rows, so that memory use does not depend on the size of the export
+    with DQXDbTools.DBCursor(returndata, databaseName, timeout=DQXDbTools.GetResponderTimeout('downloadtable'), cursorclass=MySQLdb.cursors.SSCursor) as cur:
         whc=DQXDbTools.WhereClause()
         whc.ParameterPlaceHolder='%s'#NOTE!: MySQL PyODDBC seems to require this nonstardard coding
         whc.Decode(encodedquery)
@@ -31,13 +36,30 @@ def response(returndata):
             sqlquery+=" WHERE {0}".format(whc.querystring_params)
         sqlquery+=" ORDER BY {0}".format(DQXDbTools.CreateOrderByStatement(myorderfield, sortreverse))
 
+        #Rows are only read as fast as the client consumes them, so allow MySQL to wait for a slow client
+        #The connection is not returned to the pool afterwards, so that later requests do not inherit this setting
+        cur.execute("SET SESSION net_write_timeout = %s", (getattr(config, 'DOWNLOAD_NETWRITETIMEOUT', 3600),))
+        cur.DiscardConnection()
+        #Note: the time budget of the responder applies to the execution of the query; once rows are produced,
+        #they are streamed without deadline (no further statement is executed on this cursor)
         cur.execute(sqlquery, whc.queryparams)
 
-        yield '\t'.join(str(col[0]) for col in cur.description)+'\n'
-
-        for row in cur.fetchall() :
-            line='\t'.join([str(x) for x in row])+'\n'
-            yield line
+        chunk = ['\t'.join(str(col[0]) for col in cur.description)+'\n']
+        chunksize = 0
+        while True:
+            rows = cur.fetchmany(FETCH_BATCH_ROWS)
+            if not rows:
+                break
+            for row in rows:
+                line='\t'.join([str(x) for x in row])+'\n'
+                chunk.append(line)
+                chunksize += len(line)
+            if chunksize >= OUTPUT_CHUNK_BYTES:
+                yield ''.join(chunk)
+                chunk = []
+                chunksize = 0
+        if chunk:
+            yield ''.join(chunk)
 
 def handler(start_response, response):
         status = '200 OK'
@@ -14,7 +14,7 @@ def response(returndata):
     databaseName=None
     if 'database' in returndata:
         databaseName = returndata['database']
-    with DQXDbTools.DBCursor(returndata, databaseName, read_timeout=config.TIMEOUT) as cur:
+    with DQXDbTools.DBCursor(returndata, databaseName, timeout=DQXDbTools.GetResponderTimeout('findgene')) as cur:
         mypattern=DQXDbTools.ToSafeIdentifier(returndata['pattern'])
 
         names=[]
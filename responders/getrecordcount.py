@@ -4,12 +4,45 @@
 
 import B64
 import DQXDbTools
+import DQXQueryCache
 import DQXUtils
 from DQXDbTools import DBCOLESC
 from DQXDbTools import DBTBESC
 import config
 
 
+#Counts the records matching the where clause, stopping at cap
+#The inner query projects no columns, so that MySQL does not need to materialise full rows
+def _CappedCount(cur, whc, mytablename, cap):
+    sqlquery="SELECT COUNT(*) FROM (SELECT 1 FROM {0}".format(DBTBESC(mytablename))
+    if len(whc.querystring_params) > 0:
+        sqlquery += " WHERE {0}".format(whc.querystring_params)
+    sqlquery += ' LIMIT '+str(cap)
+    sqlquery += ') as tmp_table'
+
+    if DQXDbTools.LogRequests:
+        DQXUtils.LogServer('###QRY:'+sqlquery)
+        DQXUtils.LogServer('###PARAMS:'+str(whc.queryparams))
+    cur.execute(sqlquery, whc.queryparams)
+    return cur.fetchone()[0]
+
+
+#Returns the number of rows the MySQL optimiser expects for a statement on the table, taken from EXPLAIN
+def _ExplainRowCount(cur, mytablename, sqlquery, params):
+    cur.execute('EXPLAIN ' + sqlquery, params)
+    columns = [column[0].lower() for column in cur.description]
+    rows = cur.fetchall()
+    plan = rows[0]
+    for row in rows:
+        if row[columns.index('table')] == mytablename:
+            plan = row
+            break
+    rowcount = float(plan[columns.index('rows')] or 0)
+    if ('filtered' in columns) and (plan[columns.index('filtered')] is not None):
+        rowcount *= float(plan[columns.index('filtered')]) / 100.0
+    return int(rowcount + 0.5)
+
+
 def response(returndata):
     mytablename=returndata['tbname']
     encodedquery=returndata['qry']
@@ -18,34 +51,69 @@ def response(returndata):
     if 'maxrecordcount' in returndata:
         maxrecordcount = int(returndata['maxrecordcount'])
 
+    #In approximate mode, large counts are estimated rather than counted
+    approximate = ('approx' in returndata) and (int(returndata['approx']) > 0)
+    approxprobecount = min(maxrecordcount, getattr(config, 'APPROXCOUNT_PROBE', 1000))
+
     databaseName=None
     if 'database' in returndata:
         databaseName = returndata['database']
 
-    with DQXDbTools.DBCursor(returndata, databaseName, read_timeout=config.TIMEOUT) as cur:
+    with DQXDbTools.DBCursor(returndata, databaseName, timeout=DQXDbTools.GetResponderTimeout('getrecordcount')) as cur:
         whc=DQXDbTools.WhereClause()
         whc.ParameterPlaceHolder='%s'#NOTE!: MySQL PyODDBC seems to require this nonstardard coding
         whc.Decode(encodedquery)
         whc.CreateSelectStatement()
 
+        #Use a count that is already known (e.g. from pageqry) if it is sufficient to answer the request
+        #(a count that reaches maxrecordcount is exact once truncated, so no estimate is needed)
+        countkey = DQXQueryCache.CreateCountKey(cur, DQXDbTools.ToSafeIdentifier(mytablename), whc)
+        knowncount = DQXQueryCache.GetCount(countkey)
+        if (knowncount is not None) and (knowncount[1] or (knowncount[0] >= maxrecordcount)):
+            recordcount = min(knowncount[0], maxrecordcount)
+            returndata['TotalRecordCount'] = recordcount
+            if recordcount >= maxrecordcount:
+                returndata['Truncated'] = True
+            if approximate:
+                returndata['IsEstimate'] = False
+            return returndata
+
+        #If the probe would count up to maxrecordcount anyway, the exact (truncated) count below is just as cheap
+        if approximate and (approxprobecount < maxrecordcount):
+            #A small exact count settles the question for selective queries
+            recordcount = _CappedCount(cur, whc, mytablename, approxprobecount)
+            if recordcount < approxprobecount:
+                DQXQueryCache.SetCount(countkey, recordcount, True)
+                returndata['TotalRecordCount'] = recordcount
+                returndata['IsEstimate'] = False
+                return returndata
+            DQXQueryCache.SetCount(countkey, recordcount, False)
+
+            #Otherwise, use the optimiser estimates. The count is at least the probe count,
+            #and at most the (estimated) number of rows in the table
+            sqlquery = "SELECT 1 FROM {0}".format(DBTBESC(mytablename))
+            tablerowcount = _ExplainRowCount(cur, mytablename, sqlquery, None)
+            if len(whc.querystring_params) > 0:
+                estimate = _ExplainRowCount(cur, mytablename, sqlquery + " WHERE {0}".format(whc.querystring_params), whc.queryparams)
+            else:
+                estimate = tablerowcount
+            estimatemax = max(tablerowcount, approxprobecount)
+            estimate = min(max(estimate, approxprobecount), estimatemax)
+            returndata['TotalRecordCount'] = min(estimate, maxrecordcount)
+            if estimate >= maxrecordcount:
+                returndata['Truncated'] = True
+            returndata['IsEstimate'] = True
+            returndata['EstimateMin'] = approxprobecount
+            returndata['EstimateMax'] = estimatemax
+            return returndata
 
         #Determine total number of records
-        sqlquery="SELECT COUNT(*) FROM (SELECT * FROM {0}".format(DBTBESC(mytablename))
-        if len(whc.querystring_params) > 0:
-            sqlquery += " WHERE {0}".format(whc.querystring_params)
-        sqlquery += ' LIMIT '+str(maxrecordcount)
-        sqlquery += ') as tmp_table'
-        # DQXUtils.LogServer('   executing count query...')
-        tm = DQXUtils.Timer()
-
-        if DQXDbTools.LogRequests:
-            DQXUtils.LogServer('###QRY:'+sqlquery)
-            DQXUtils.LogServer('###PARAMS:'+str(whc.queryparams))
-        cur.execute(sqlquery, whc.queryparams)
-        # DQXUtils.LogServer('   finished in {0}s'.format(tm.Elapsed()))
-        recordcount = cur.fetchone()[0]
+        recordcount = _CappedCount(cur, whc, mytablename, maxrecordcount)
         returndata['TotalRecordCount'] = recordcount
         if recordcount >= maxrecordcount:
             returndata['Truncated'] = True
+        DQXQueryCache.SetCount(countkey, recordcount, recordcount < maxrecordcount)
+        if approximate:
+            returndata['IsEstimate'] = False
 
         return returndata
@@ -0,0 +1,43 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# Exposes the metrics collected by DQXMetrics, in the Prometheus text exposition format
+
+import DQXMetrics
+import DQXQueryCache
+import DQXResponders
+
+
+#Renders the statistics of the query result & record count caches
+def _RenderCacheStatistics(lines):
+    caches = [('result', DQXQueryCache.GetStatistics()), ('count', DQXQueryCache.GetCountStatistics())]
+    for name, key, metricType, description in [
+        ('dqx_querycache_hits_total', 'hits', 'counter', 'Number of lookups that found a cached entry'),
+        ('dqx_querycache_misses_total', 'misses', 'counter', 'Number of lookups that found no cached entry'),
+        ('dqx_querycache_evictions_total', 'evictions', 'counter', 'Number of entries evicted to stay within the limits'),
+        ('dqx_querycache_hit_ratio', 'hitRatio', 'gauge', 'Fraction of lookups that found a cached entry'),
+        ('dqx_querycache_entries', 'entries', 'gauge', 'Number of cached entries'),
+        ('dqx_querycache_bytes', 'bytes', 'gauge', 'Estimated size of the cached entries'),
+        ]:
+        lines.append('# HELP {0} {1}\n'.format(name, description))
+        lines.append('# TYPE {0} {1}\n'.format(name, metricType))
+        for cache, statistics in caches:
+            lines.append('{0}{{cache="{1}"}} {2!r}\n'.format(name, cache, statistics[key]))
+
+
+def response(returndata):
+    return returndata
+
+
+def handler(start_response, response):
+    lines = [DQXMetrics.registry.Render()]
+    _RenderCacheStatistics(lines)
+    lines.append('# HELP dqx_responder_import_seconds Time taken to import responder modules\n')
+    lines.append('# TYPE dqx_responder_import_seconds gauge\n')
+    for moduleName, duration in DQXResponders.registry.GetImportTimes().items():
+        lines.append('dqx_responder_import_seconds{{module="{0}"}} {1!r}\n'.format(moduleName, duration))
+    content = ''.join(lines)
+    start_response('200 OK', [('Content-type', 'text/plain; version=0.0.4'),
+                              ('Content-Length', str(len(content)))])
+    yield content
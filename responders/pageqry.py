@@ -2,13 +2,111 @@
 # This program is free software licensed under the GNU Affero General Public License.
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
+import sys
+import threading
+import simplejson
+import arraybuffer
 import B64
+import DQXbase64
 import DQXDbTools
+import DQXDbMetadata
+import DQXLogging
+import DQXMetrics
+import DQXQueryCache
 import DQXUtils
 from DQXDbTools import DBCOLESC
 from DQXDbTools import DBTBESC
 import config
-import lzstring
+
+
+#Keyset (seek) pagination: rows are ordered by the sort fields, followed by the primary key as tie breaker,
+#and each page carries an opaque cursor holding these values for its last row
+#The next page then starts with a WHERE seek beyond the cursor values (see CreateSeekCondition) instead of a LIMIT offset
+def CreateCursorToken(sortfields, sortreverse, values):
+    return DQXbase64.b64encode_var2(simplejson.dumps({'Fields': sortfields, 'Reverse': sortreverse, 'Values': values}, use_decimal=True, default=str))
+
+
+def DecodeCursorToken(token, sortfields, sortreverse):
+    content = simplejson.loads(DQXbase64.b64decode_var2(str(token)), use_decimal=True)
+    if (content['Fields'] != sortfields) or (content['Reverse'] != sortreverse):
+        raise Exception('Pagination cursor does not match the sort order of the query')
+    return content['Values']
+
+
+#Returns the condition (and its parameters) selecting the rows that come after the key values in the sort order
+#It is written as a > x OR (a = x AND (b > y OR ...)) rather than as a row comparison, which older MySQL versions
+#do not use for index range scans. MySQL sorts absent values first in ascending order, and last in descending order,
+#so that in descending order rows with an absent sort value come after any key (cursors never hold absent values)
+def CreateSeekCondition(fields, sortreverse, values):
+    condition = None
+    params = []
+    for field, value in reversed(zip(fields, values)):
+        column = DBCOLESC(field)
+        clause = '{0} {1} %s'.format(column, '<' if sortreverse else '>')
+        clauseparams = [value]
+        if sortreverse and (condition is not None):
+            #Note: the last field is the primary key, which is never absent
+            clause += ' OR {0} IS NULL'.format(column)
+        if condition is not None:
+            clause += ' OR ({0} = %s AND {1})'.format(column, condition)
+            clauseparams += [value] + params
+        condition = '(' + clause + ')'
+        params = clauseparams
+    return condition, params
+
+
+#Runs the record count of a pageqry on its own pooled connection, in a background thread,
+#so that it overlaps with the page query. If either of both fails, the other one is cancelled
+class _BackgroundCount(object):
+    def __init__(self, returndata, databaseName, timeout, sqlquery, params, partner):
+        #Only the fields that determine the credentials are copied, as the caller keeps modifying returndata
+        self.credentialdata = dict((key, returndata[key]) for key in ('isRunningLocal', 'environ') if key in returndata)
+        self.databaseName = databaseName
+        self.timeout = timeout
+        self.sqlquery = sqlquery
+        self.params = params
+        self.partner = partner #cursor running the page query
+        self.lock = threading.Lock()
+        self.cur = None
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.metricsContext = DQXMetrics.GetContext()
+        self.requestId = DQXLogging.GetRequestId()
+        self.thread = threading.Thread(target=self._Run, name='pageqry-count')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _Run(self):
+        DQXMetrics.SetContext(self.metricsContext)
+        DQXLogging.SetRequestId(self.requestId)
+        try:
+            with DQXDbTools.DBCursor(self.credentialdata, self.databaseName, timeout=self.timeout) as cur:
+                with self.lock:
+                    self.cur = cur
+                    if self.cancelled:
+                        cur.Cancel()
+                DQXUtils.LogServer('   executing count query...')
+                tm = DQXUtils.Timer()
+                cur.execute(self.sqlquery, self.params)
+                DQXUtils.LogServer('   finished in {0}s'.format(tm.Elapsed()))
+                self.result = cur.fetchone()[0]
+        except:
+            self.error = sys.exc_info()
+            self.partner.Cancel()
+
+    def Cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.cur is not None:
+                self.cur.Cancel()
+
+    #Waits for the count to finish, and returns it (or raises the error it failed with)
+    def Wait(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
 
 
 def response(returndata):
@@ -17,30 +115,41 @@ def response(returndata):
     myorderfield = returndata.get('order', None)
     sortreverse = int(returndata['sortreverse']) > 0
     isdistinct = ('distinct' in returndata) and (int(returndata['distinct']) > 0)
-    mycolumns=DQXDbTools.ParseColumnEncoding(lzstring.decompressFromEncodedURIComponent(returndata['collist']))
+    mycolumns=DQXDbTools.DecodeColumnList(returndata['collist'])
     groupby = returndata.get('groupby', None)
+    arrayformat = returndata.get('format', None) == 'arraybuffer'
+
+    keyset = None
+    if ('primkey' in returndata) and (len(returndata['primkey']) > 0):
+        if isdistinct or groupby:
+            raise Exception('Keyset pagination is not supported for distinct or grouped queries')
+        sortfields = []
+        if myorderfield and (myorderfield != 'null'):
+            sortfields = [DQXDbTools.ToSafeIdentifier(field) for field in myorderfield.split('~')]
+        sortfields.append(DQXDbTools.ToSafeIdentifier(returndata['primkey']))
+        keyset = {'Fields': sortfields, 'After': None}
+        if ('cursor' in returndata) and (len(returndata['cursor']) > 0):
+            keyset['After'] = DecodeCursorToken(returndata['cursor'], sortfields, sortreverse)
 
     databaseName=None
     if 'database' in returndata:
         databaseName = returndata['database']
-    with DQXDbTools.DBCursor(returndata, databaseName, read_timeout=config.TIMEOUT) as cur:
+    with DQXDbTools.DBCursor(returndata, databaseName, timeout=DQXDbTools.GetResponderTimeout('pageqry')) as cur:
         whc=DQXDbTools.WhereClause()
         whc.ParameterPlaceHolder='%s'#NOTE!: MySQL PyODDBC seems to require this nonstardard coding
         whc.Decode(encodedquery)
         whc.CreateSelectStatement()
 
-        #Determine total number of records
-        if int(returndata['needtotalcount'])>0:
-            sqlquery = "SELECT COUNT(*) FROM {0}".format(DBTBESC(mytablename))
-            if len(whc.querystring_params) > 0:
-                sqlquery += " WHERE {0}".format(whc.querystring_params)
-            DQXUtils.LogServer('   executing count query...')
-            tm = DQXUtils.Timer()
-            cur.execute(sqlquery, whc.queryparams)
-            DQXUtils.LogServer('   finished in {0}s'.format(tm.Elapsed()))
-            returndata['TotalRecordCount'] = cur.fetchone()[0]
+        #Reject unknown column names before sending anything to MySQL
+        usedcolumns = [x['Name'] for x in mycolumns] + whc.GetColumnNames()
+        if myorderfield and (myorderfield != 'null'):
+            usedcolumns += myorderfield.split('~')
+        if groupby:
+            usedcolumns += groupby.split('~')
+        if keyset:
+            usedcolumns += keyset['Fields']
+        DQXDbMetadata.VerifyColumns(cur, DQXDbTools.ToSafeIdentifier(mytablename), usedcolumns)
 
-        #Fetch the actual data
         strrownr1, strrownr2 = returndata['limit'].split('~')
         rownr1 = int(0.5+float(strrownr1))
         rownr2 = int(0.5+float(strrownr2))
@@ -49,45 +158,150 @@ def response(returndata):
         if rownr2 <= rownr1:
             rownr2 = rownr1+1
 
-        #sqlquery = "select benchmark(9999999999, md5('when will it end?')); SELECT "
-        sqlquery = "SELECT "
-        if isdistinct:
-            sqlquery = "SELECT DISTINCT "
-        sqlquery += "{0} FROM {1}".format(','.join([DBCOLESC(x['Name']) for x in mycolumns]), DBTBESC(mytablename))
-        if len(whc.querystring_params) > 0:
-            sqlquery += " WHERE {0}".format(whc.querystring_params)
-        if myorderfield and len(myorderfield) > 0:
-            sqlquery += " ORDER BY {0}".format(DQXDbTools.CreateOrderByStatement(myorderfield, sortreverse))
-        if groupby and len(groupby) > 0:
-            sqlquery += " GROUP BY " + ','.join(map(DBCOLESC, groupby.split('~')))
-        sqlquery += " LIMIT {0}, {1}".format(rownr1, rownr2-rownr1+1)
-
-
-        if DQXDbTools.LogRequests:
-            DQXUtils.LogServer('###QRY:'+sqlquery)
-            DQXUtils.LogServer('###PARAMS:'+str(whc.queryparams))
-
-        cur.execute(sqlquery, whc.queryparams)
-
-        returndata['DataType'] = 'Points'
-        pointsx = []
-        yvalrange = range(0, len(mycolumns))
-        pointsy = []
-        for ynr in yvalrange:
-            pointsy.append([])
-        rowidx = 0
-        for row in cur.fetchall():
-            pointsx.append(rownr1+rowidx)
-            for ynr in yvalrange:
-                if row[ynr] != None:
-                    pointsy[ynr].append(row[ynr])
-                else:
-                    pointsy[ynr].append(None)
-            rowidx += 1
-
-        valcoder = B64.ValueListCoder()
-        returndata['XValues'] = valcoder.EncodeIntegersByDifferenceB64(pointsx)
-        for ynr in yvalrange:
-            returndata[mycolumns[ynr]['Name']] = valcoder.EncodeByMethod(pointsy[ynr], mycolumns[ynr]['Encoding'])
+        needtotalcount = int(returndata['needtotalcount']) > 0
+        cachekey = DQXQueryCache.CreateKey(cur, 'pageqry', DQXDbTools.ToSafeIdentifier(mytablename), whc, {
+            'columns': mycolumns,
+            'order': myorderfield,
+            'sortreverse': sortreverse,
+            'distinct': isdistinct,
+            'groupby': groupby,
+            'rows': [rownr1, rownr2],
+            'keyset': keyset,
+            'arrayformat': arrayformat
+        })
+
+        #Determine total number of records (reused for all pages of the same query)
+        if needtotalcount:
+            countkey = DQXQueryCache.CreateCountKey(cur, DQXDbTools.ToSafeIdentifier(mytablename), whc)
+            knowncount = DQXQueryCache.GetCount(countkey)
+            if (knowncount is not None) and knowncount[1]:
+                returndata['TotalRecordCount'] = knowncount[0]
+
+        countquery = None
+        if needtotalcount and ('TotalRecordCount' not in returndata):
+            countquery = "SELECT COUNT(*) FROM {0}".format(DBTBESC(mytablename))
+            if len(whc.querystring_params) > 0:
+                countquery += " WHERE {0}".format(whc.querystring_params)
+
+        result = DQXQueryCache.Get(cachekey)
+        if result is not None:
+            returndata.update(result)
+        else:
+            #The count and the page are independent, and run at the same time on two connections
+            backgroundcount = None
+            if countquery is not None:
+                backgroundcount = _BackgroundCount(returndata, databaseName, cur.GetRemainingTime(), countquery, whc.queryparams, cur)
+            try:
+                result = _FetchPage(cur, whc, mytablename, mycolumns, myorderfield, sortreverse, isdistinct, groupby, rownr1, rownr2, keyset, arrayformat)
+            except DQXDbTools.Cancelled:
+                #The count failed first: report its error rather than the cancellation
+                if backgroundcount is not None:
+                    backgroundcount.Wait()
+                raise
+            except:
+                if backgroundcount is not None:
+                    backgroundcount.Cancel()
+                    backgroundcount.thread.join()
+                raise
+            DQXQueryCache.Set(cachekey, result)
+            returndata.update(result)
+            if backgroundcount is not None:
+                returndata['TotalRecordCount'] = backgroundcount.Wait()
+                DQXQueryCache.SetCount(countkey, returndata['TotalRecordCount'], True)
+                countquery = None
+
+        if countquery is not None:
+            DQXUtils.LogServer('   executing count query...')
+            tm = DQXUtils.Timer()
+            cur.execute(countquery, whc.queryparams)
+            DQXUtils.LogServer('   finished in {0}s'.format(tm.Elapsed()))
+            returndata['TotalRecordCount'] = cur.fetchone()[0]
+            DQXQueryCache.SetCount(countkey, returndata['TotalRecordCount'], True)
+
+        if arrayformat:
+            #Note: the cached list is not modified
+            returndata['ArrayBuffer'] = result['ArrayBuffer'] + [
+                (name, arraybuffer.scalar_array(returndata[name])) for name in ['TotalRecordCount', 'NextCursor'] if name in returndata
+            ]
 
         return returndata
+
+
+#Fetches the actual data of a page
+def _FetchPage(cur, whc, mytablename, mycolumns, myorderfield, sortreverse, isdistinct, groupby, rownr1, rownr2, keyset, arrayformat):
+    result = {}
+    pagesize = rownr2-rownr1+1
+    selectcolumns = [DBCOLESC(x['Name']) for x in mycolumns]
+    whereclauses = []
+    queryparams = list(whc.queryparams)
+    if len(whc.querystring_params) > 0:
+        whereclauses.append(whc.querystring_params)
+    if keyset:
+        #The key values of the last row are fetched as extra columns, to build the cursor of the next page
+        selectcolumns += [DBCOLESC(field) for field in keyset['Fields']]
+        if keyset['After'] is not None:
+            seekcondition, seekparams = CreateSeekCondition(keyset['Fields'], sortreverse, keyset['After'])
+            whereclauses.append(seekcondition)
+            queryparams += seekparams
+
+    #sqlquery = "select benchmark(9999999999, md5('when will it end?')); SELECT "
+    sqlquery = "SELECT "
+    if isdistinct:
+        sqlquery = "SELECT DISTINCT "
+    sqlquery += "{0} FROM {1}".format(','.join(selectcolumns), DBTBESC(mytablename))
+    if len(whereclauses) > 0:
+        sqlquery += " WHERE {0}".format(' AND '.join(whereclauses))
+    if keyset:
+        sqlquery += " ORDER BY {0}".format(', '.join(["{0}{1}".format(DBCOLESC(field), " DESC" if sortreverse else "") for field in keyset['Fields']]))
+    elif myorderfield and len(myorderfield) > 0:
+        sqlquery += " ORDER BY {0}".format(DQXDbTools.CreateOrderByStatement(myorderfield, sortreverse))
+    if groupby and len(groupby) > 0:
+        sqlquery += " GROUP BY " + ','.join(map(DBCOLESC, groupby.split('~')))
+    if keyset and (keyset['After'] is not None):
+        sqlquery += " LIMIT {0}".format(pagesize)
+    else:
+        sqlquery += " LIMIT {0}, {1}".format(rownr1, pagesize)
+
+
+    if DQXDbTools.LogRequests:
+        DQXUtils.LogServer('###QRY:'+sqlquery)
+        DQXUtils.LogServer('###PARAMS:'+str(queryparams))
+
+    cur.execute(sqlquery, queryparams)
+
+    result['DataType'] = 'Points'
+    pointsx = []
+    yvalrange = range(0, len(mycolumns))
+    pointsy = []
+    for ynr in yvalrange:
+        pointsy.append([])
+    rowidx = 0
+    rows = cur.fetchall()
+    for row in rows:
+        pointsx.append(rownr1+rowidx)
+        for ynr in yvalrange:
+            if row[ynr] != None:
+                pointsy[ynr].append(row[ynr])
+            else:
+                pointsy[ynr].append(None)
+        rowidx += 1
+
+    if keyset and (len(rows) == pagesize):
+        lastkey = list(rows[-1][len(mycolumns):])
+        #Absent values cannot be sought for; the client falls back to row number access in that case
+        if None not in lastkey:
+            result['NextCursor'] = CreateCursorToken(keyset['Fields'], sortreverse, lastkey)
+
+    if arrayformat:
+        #Binary response: typed arrays instead of text encoded value lists
+        result['ArrayBuffer'] = [('XValues', arraybuffer.typed_array(pointsx, 'ID'))] + [
+            (mycolumns[ynr]['Name'], arraybuffer.typed_array(pointsy[ynr], mycolumns[ynr]['Encoding'])) for ynr in yvalrange
+        ]
+        return result
+
+    valcoder = B64.ValueListCoder()
+    result['XValues'] = valcoder.EncodeIntegersByDifferenceB64(pointsx)
+    for ynr in yvalrange:
+        result[mycolumns[ynr]['Name']] = valcoder.EncodeByMethod(pointsy[ynr], mycolumns[ynr]['Encoding'])
+
+    return result
@@ -2,13 +2,15 @@
 # This program is free software licensed under the GNU Affero General Public License.
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
+import arraybuffer
 import B64
 import DQXDbTools
+import DQXDbMetadata
+import DQXQueryCache
 import DQXUtils
 from DQXDbTools import DBCOLESC
 from DQXDbTools import DBTBESC
 import config
-import lzstring
 
 def response(returndata):
 
@@ -18,17 +20,33 @@ def response(returndata):
     myorderfield = DQXDbTools.ToSafeIdentifier(returndata['order'])
     # DQXUtils.LogServer('orderfield: '+myorderfield)
 
-    mycolumns=DQXDbTools.ParseColumnEncoding(lzstring.decompressFromEncodedURIComponent(returndata['collist']))
+    mycolumns=DQXDbTools.DecodeColumnList(returndata['collist'])
+    arrayformat = returndata.get('format', None) == 'arraybuffer'
 
     databaseName = None
     if 'database' in returndata:
         databaseName = returndata['database']
-    with DQXDbTools.DBCursor(returndata, databaseName, read_timeout=config.TIMEOUT) as cur:
+    with DQXDbTools.DBCursor(returndata, databaseName, timeout=DQXDbTools.GetResponderTimeout('qry')) as cur:
         whc=DQXDbTools.WhereClause()
         whc.ParameterPlaceHolder = '%s' #NOTE!: MySQL PyODDBC seems to require this nonstardard coding
         whc.Decode(encodedquery)
         whc.CreateSelectStatement()
 
+        #Reject unknown column names before sending anything to MySQL
+        DQXDbMetadata.VerifyColumns(cur, mytablename, [myposfield, myorderfield] + [x['Name'] for x in mycolumns] + whc.GetColumnNames())
+
+        cachekey = DQXQueryCache.CreateKey(cur, 'qry', mytablename, whc, {
+            'posfield': myposfield,
+            'columns': mycolumns,
+            'order': myorderfield,
+            'arrayformat': arrayformat
+        })
+        result = DQXQueryCache.Get(cachekey)
+        if result is not None:
+            returndata.update(result)
+            return returndata
+        result = {}
+
         sqlquery="SELECT {posfield}, {columnames} FROM {tablename}".format(
             posfield=DBCOLESC(myposfield),
             columnames=','.join([DBCOLESC(x['Name']) for x in mycolumns]),
@@ -46,7 +64,7 @@ def response(returndata):
             DQXUtils.LogServer('###PARAMS:'+str(whc.queryparams))
         cur.execute(sqlquery, whc.queryparams)
 
-        returndata['DataType'] = 'Points'
+        result['DataType'] = 'Points'
         pointsx = []
         yvalrange=range(0, len(mycolumns))
         pointsy = []
@@ -60,9 +78,20 @@ def response(returndata):
                 else:
                     pointsy[ynr].append(None)
 
+        if arrayformat:
+            #Binary response: typed arrays instead of text encoded value lists
+            result['ArrayBuffer'] = [('XValues', arraybuffer.typed_array(pointsx, 'ID'))] + [
+                (mycolumns[ynr]['Name'], arraybuffer.typed_array(pointsy[ynr], mycolumns[ynr]['Encoding'])) for ynr in yvalrange
+            ]
+            DQXQueryCache.Set(cachekey, result)
+            returndata.update(result)
+            return returndata
+
         valcoder = B64.ValueListCoder()
-        returndata['XValues'] = valcoder.EncodeIntegersByDifferenceB64(pointsx)
+        result['XValues'] = valcoder.EncodeIntegersByDifferenceB64(pointsx)
         for ynr in yvalrange:
-            returndata[mycolumns[ynr]['Name']] = valcoder.EncodeByMethod(pointsy[ynr], mycolumns[ynr]['Encoding'])
+            result[mycolumns[ynr]['Name']] = valcoder.EncodeByMethod(pointsy[ynr], mycolumns[ynr]['Encoding'])
 
+        DQXQueryCache.Set(cachekey, result)
+        returndata.update(result)
         return returndata
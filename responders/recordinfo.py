@@ -3,6 +3,7 @@
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
 import DQXDbTools
+import DQXDbMetadata
 import DQXUtils
 from DQXDbTools import DBCOLESC
 from DQXDbTools import DBTBESC
@@ -15,11 +16,12 @@ def response(returndata):
     databaseName = None
     if 'database' in returndata:
         databaseName = returndata['database']
-    with DQXDbTools.DBCursor(returndata, databaseName, read_timeout=config.TIMEOUT) as cur:
+    with DQXDbTools.DBCursor(returndata, databaseName, timeout=DQXDbTools.GetResponderTimeout('recordinfo')) as cur:
         whc = DQXDbTools.WhereClause()
         whc.ParameterPlaceHolder = '%s' #NOTE!: MySQL PyODDBC seems to require this nonstardard coding
         whc.Decode(encodedquery)
         whc.CreateSelectStatement()
+        DQXDbMetadata.VerifyColumns(cur, DQXDbTools.ToSafeIdentifier(mytablename), whc.GetColumnNames())
 
         sqlquery = "SELECT * FROM {0} WHERE {1}".format(
             DBTBESC(mytablename),
@@ -0,0 +1,19 @@
+# This file is part of DQXServer - (C) Copyright 2014, Paul Vauterin, Ben Jeffery, Alistair Miles <info@cggh.org>
+# This program is free software licensed under the GNU Affero General Public License.
+# You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
+
+# Returns the statements recorded by the slow query log (most recent first), including their EXPLAIN plans
+# Restricted to users that can modify the main database. clear=1 empties the log after reading it
+
+import DQXDbTools
+import config
+
+
+def response(returndata):
+    credInfo = DQXDbTools.CredentialInformation(returndata)
+    credInfo.VerifyCanDo(DQXDbTools.DbOperationWrite(config.DB))
+    returndata['Threshold'] = DQXDbTools.slowQueryLog.threshold
+    returndata['SlowQueries'] = DQXDbTools.slowQueryLog.GetEntries()
+    if ('clear' in returndata) and (int(returndata['clear']) > 0):
+        DQXDbTools.slowQueryLog.Clear()
+    return returndata
@@ -2,60 +2,220 @@
 # This program is free software licensed under the GNU Affero General Public License.
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
+import math
+import mmap
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
 import B64
 import config
+import DQXCache
 import DQXUtils
 
+
+#Returns a string identifying the current version of <chromoid>_pos.txt: its size and modification time (in microseconds)
+def PositionFileSignature(datadir,chromoid):
+    st=os.stat(datadir+'/'+chromoid+'_pos.txt')
+    return '{0}.{1}'.format(st.st_size,int(round(st.st_mtime*1000000)))
+
+
+#The binary form of a position index is <chromoid>_pos.<signature>.npy, signature identifying the version of
+#<chromoid>_pos.txt it was created from, so that any change to the text file (even one that keeps an older
+#modification time, e.g. rsync -a) causes it to be created again
+def _BinaryPositionFile(datadir,chromoid,signature):
+    return datadir+'/'+chromoid+'_pos.'+signature+'.npy'
+
+
+#Creates the binary form of a position index from <chromoid>_pos.txt, and returns the positions
+#The positions are stored as 32 bit integers if possible, and as 64 bit integers otherwise
+def CreatePositionIndex(datadir,chromoid,signature):
+    with open(datadir+'/'+chromoid+'_pos.txt') as f:
+        posits=np.array(f.read().split(),dtype=np.int64)
+    if np.any(np.diff(posits)<0):
+        raise Exception('Positions are not sorded')
+    if (len(posits)==0) or ((posits.min()>=-2**31) and (posits.max()<2**31)):
+        posits=posits.astype('<i4')
+    if PositionFileSignature(datadir,chromoid)!=signature:
+        raise Exception('Position file {0} {1} changed while being read'.format(datadir,chromoid))
+    binFile=_BinaryPositionFile(datadir,chromoid,signature)
+    tmpFile='{0}.{1}.tmp'.format(binFile,os.getpid())
+    try:
+        with open(tmpFile,'wb') as f:
+            np.save(f,posits)
+        os.rename(tmpFile,binFile)
+    except (IOError, OSError) as e:
+        DQXUtils.LogServer('Unable to write position index {0}: {1}'.format(binFile,str(e)))
+        return posits
+    #Remove the binary forms of previous versions
+    staleMatcher=re.compile(re.escape(chromoid+'_pos.')+r'\d+\.\d+\.npy\Z')
+    for fileName in os.listdir(datadir):
+        if staleMatcher.match(fileName) and (datadir+'/'+fileName!=binFile):
+            try:
+                os.remove(datadir+'/'+fileName)
+            except OSError:
+                pass
+    return np.load(binFile,mmap_mode='r')
+
+
+#Returns the positions of a chromosome as a (memory mapped, read only) array
+def LoadPositions(datadir,chromoid,signature):
+    binFile=_BinaryPositionFile(datadir,chromoid,signature)
+    if os.path.exists(binFile):
+        return np.load(binFile,mmap_mode='r')
+    return CreatePositionIndex(datadir,chromoid,signature)
+
+
 class PositionIndex:
-    def __init__(self,datadir,ichromoid):
+    def __init__(self,datadir,ichromoid,signature):
         self.chromoid=ichromoid
+        self.signature=signature
         DQXUtils.LogServer('Loading position index {0} {1}'.format(datadir,self.chromoid))
-        f=open(datadir+'/'+self.chromoid+'_pos.txt')
-        self.posits=[int(x) for x in f.readlines()]
-        #check that they are in order
-        for i in range(len(self.posits)-1):
-            if self.posits[i+1]<self.posits[i]:
-                raise Exception('Positions are not sorded')
-        f.close()
+        self.posits=LoadPositions(datadir,self.chromoid,signature)
+        if len(self.posits)==0:
+            raise Exception('Position index {0} {1} is empty'.format(datadir,self.chromoid))
+        self.nbytes=self.posits.nbytes
+    #Converts a position to a scalar of the index type, so that searchsorted does not convert the whole array
+    def _Key(self,pos):
+        info=np.iinfo(self.posits.dtype)
+        return self.posits.dtype.type(min(max(pos,info.min),info.max))
+    #Index of the last position before pos (clipped to the range 0..count-2)
     def Pos2IndexLeft(self,pos):
-        i1 = 0
-        p1 = self.posits[i1]
-        i2 = len(self.posits)-1
-        p2 = self.posits[i2]
-        while (p1 < pos) and (i2 > i1 + 1):
-            i3 = int((i1 + i2) / 2.0)
-            p3=self.posits[i3]
-            if p3 >= pos:
-                i2 = i3
-                p2 = p3
-            else:
-                i1 = i3
-                p1 = p3
-        return i1
+        idx=int(self.posits.searchsorted(self._Key(math.ceil(pos)),'left'))-1
+        return max(0,min(idx,len(self.posits)-2))
+    #Index of the first position after pos (clipped to the range 1..count-1)
     def Pos2IndexRight(self,pos):
-        i1 = 0
-        p1 = self.posits[i1]
-        i2 = len(self.posits)-1
-        p2 = self.posits[i2]
-        while (p2 > pos) and (i2 > i1 + 1):
-            i3 = int((i1 + i2) / 2.0)
-            p3=self.posits[i3]
-            if p3 <= pos:
-                i1 = i3
-                p1 = p3
+        idx=int(self.posits.searchsorted(self._Key(math.floor(pos)),'right'))
+        return max(min(1,len(self.posits)-1),min(idx,len(self.posits)-1))
+
+#A read only memory map of a snp record file
+class MappedFile:
+    def __init__(self,fileName):
+        self.fileName=fileName
+        self.cached=False #maps that are not cached are only used by a single thread
+        with open(fileName,'rb') as f:
+            st=os.fstat(f.fileno())
+            self.mtime=st.st_mtime
+            self.size=st.st_size
+            if self.size>0:
+                self.map=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
             else:
-                i2 = i3
-                p2 = p3
-        return i2
+                self.map='' #empty files can not be mapped
+    #Returns a copy of a range of the file, as a uint8 array
+    #Note: numpy releases the GIL while copying, so that page faults on the map do not block other threads
+    def Read(self,offset,length):
+        length=max(0,min(length,self.size-offset))
+        if length==0:
+            return np.zeros(0,dtype=np.uint8)
+        return np.frombuffer(self.map,dtype=np.uint8,count=length,offset=offset).copy()
+    def Close(self):
+        if self.size>0:
+            self.map.close()
 
-indexes={}
+#Record files are kept mapped between requests, up to SNPINFO_MAXOPENFILES (each map holds a file descriptor)
+#Note: maps are not closed explicitly when evicted or replaced, as another thread may still be reading them
+#(they are released, with their file descriptor, once the last reader is done)
+openFiles=DQXCache.LRUCache(maxCount=getattr(config,'SNPINFO_MAXOPENFILES',4096))
 
+#Returns the map of a file, which is reopened if the file was modified since it was mapped
+#If cache is False, a map that is not open yet is not added to the cache (the caller closes it after use)
+def GetMappedFile(fileName,cache=True):
+    st=os.stat(fileName)
+    mapped=openFiles.Get(fileName)
+    if (mapped is None) or (mapped.mtime!=st.st_mtime) or (mapped.size!=st.st_size):
+        mapped=MappedFile(fileName)
+        if cache:
+            mapped.cached=True
+            openFiles.Set(fileName,mapped)
+    return mapped
+
+#Returns fixed length records read from a file as a matrix (one row per record)
+def RecordMatrix(data,recLen,recCount,fileName):
+    if len(data)!=recLen*recCount:
+        raise Exception('Unable to read {0} records of {1} bytes from {2}'.format(recCount,recLen,fileName))
+    return data.reshape(recCount,recLen)
+
+_ioPoolLock=threading.Lock()
+_ioPool=None
+
+#The I/O thread pool is shared by all requests, so that the number of concurrent reads stays bounded
+def _GetIOPool():
+    global _ioPool
+    with _ioPoolLock:
+        if _ioPool is None:
+            _ioPool=ThreadPool(getattr(config,'SNPINFO_IOTHREADS',8))
+        return _ioPool
+
+def _ReadRecords(item):
+    fileName,recLen,recStart,recCount,cache=item
+    mapped=GetMappedFile(fileName,cache)
+    data=mapped.Read(recLen*recStart,recLen*recCount)
+    if not mapped.cached:
+        mapped.Close()
+    return RecordMatrix(data,recLen,recCount,fileName)
+
+#Reads ranges of records from several files concurrently. items is a list of (fileName, recLen, recStart, recCount),
+#and the record matrices are returned in the same order
+#If a request reads more files than can be kept open, the files that are not open yet are only mapped for the
+#duration of the read, as caching them would evict all maps before they are used again
+def ReadRecords(items):
+    cache=len(items)<=openFiles.maxCount
+    items=[item+(cache,) for item in items]
+    if len(items)<=1:
+        return [_ReadRecords(item) for item in items]
+    return _GetIOPool().map(_ReadRecords,items,chunksize=1)
+
+#Position indexes are kept up to a total size of SNPINFO_INDEXCACHE_MAXBYTES (memory mapped)
+indexes=DQXCache.LRUCache(maxBytes=getattr(config,'SNPINFO_INDEXCACHE_MAXBYTES',256*1024*1024))
+_indexLoadLock=threading.Lock()
+_indexLoading={} #maps index id to the lock held by the thread loading it
+
+#Returns the position index of a chromosome. Concurrent requests for an index that is not loaded yet wait for a single load
+#An index is loaded again when its position file changed
 def GetPositionIndex(datadir,chromoid):
-    global indexes
     id=datadir+'_'+chromoid
-    if not(id in indexes):
-        indexes[id]=PositionIndex(datadir,chromoid)
-    return indexes[id]
+    signature=PositionFileSignature(datadir,chromoid)
+    index=indexes.Get(id)
+    if (index is None) or (index.signature!=signature):
+        with _indexLoadLock:
+            loadLock=_indexLoading.setdefault(id,threading.Lock())
+        try:
+            with loadLock:
+                index=indexes.Get(id)
+                if (index is None) or (index.signature!=signature):
+                    index=PositionIndex(datadir,chromoid,signature)
+                    indexes.Set(id,index)
+        finally:
+            #Note: a newer load may have registered its own lock meanwhile (e.g. after the index was evicted)
+            with _indexLoadLock:
+                if _indexLoading.get(id) is loadLock:
+                    del _indexLoading[id]
+    return index
+
+#Returns the indexes of at most maxPoints snps, selected from the passing snps (indexes in passedIdx, positions in posits)
+#  - 'spread': evenly spread over the list of passing snps, always including the first and the last one
+#  - 'bins': the first snp of each non empty bin, dividing the range startps-endps in maxPoints bins of equal size
+#    The snps outside the range (the flanking snps included in the response) are always kept
+def Decimate(passedIdx,posits,maxPoints,mode,startps,endps):
+    if mode=='spread':
+        return passedIdx[np.round(np.linspace(0,len(passedIdx)-1,maxPoints)).astype(np.int64)]
+    if mode=='bins':
+        inside=(posits>=startps)&(posits<=endps)
+        keep=~inside
+        insideNrs=np.flatnonzero(inside)
+        if endps>startps:
+            binNrs=np.floor((posits[insideNrs]-startps)*(maxPoints/(endps-startps)))
+            binNrs=np.clip(binNrs,0,maxPoints-1)
+        else:
+            binNrs=np.zeros(len(insideNrs))
+        #Positions are sorted, so the first snp of a bin is where the bin number changes
+        isFirst=np.ones(len(binNrs),dtype=bool)
+        isFirst[1:]=binNrs[1:]!=binNrs[:-1]
+        keep[insideNrs[isFirst]]=True
+        return passedIdx[keep]
+    raise Exception('Invalid decimation mode {0}'.format(mode))
 
 def response(returndata):
 #    mytablename=DQXDbTools.ToSafeIdentifier(returndata['tbname'])
@@ -74,48 +234,42 @@ def response(returndata):
     index=GetPositionIndex(datadir,chromoid)
     idx1=index.Pos2IndexLeft(startps)
     idx2=index.Pos2IndexRight(endps)
-    origSNPCount = idx2-idx1+1
+    origSNPCount = max(0,idx2-idx1+1) #a reversed range (start after stop) gives an empty result
 
     coder=B64.ValueListCoder()
-    b64=B64.B64()
     origPosits=index.posits[idx1:idx2+1]
 
-    f=open(datadir+'/'+chromoid+'_snpinfo.txt')
-    f.seek(snpInfoRecLen*idx1)
-    snpdata=f.read(snpInfoRecLen*origSNPCount)
-    f.close()
-
-    seqvals={}
+    readItems=[(datadir+'/'+chromoid+'_snpinfo.txt',snpInfoRecLen,idx1,origSNPCount)]
     for seqid in seqids:
-        f=open(datadir+'/'+chromoid+'_'+seqid+'.txt')
-        f.seek(snpCallRecLen*idx1)
-        seqvals[seqid]=f.read(snpCallRecLen*origSNPCount)
-        f.close()
-
-    origPassedList=[]
-    for i in range(origSNPCount):
-        filterValues = b64.B642BooleanList(snpdata,i*snpInfoRecLen,filterCount)
-        if len(filterValues)!=filterCount:
-            raise Exception('???')
-        passed=True
-        for filterTestNr in range(filterCount):
-            if (filterStatus[filterTestNr]) and (filterValues[filterTestNr]):
-                passed=False
-        origPassedList.append(passed)
-
-    passedPosits=[]
-    passedSNPData=[]
-    passedSeqVals={ seqid:[] for seqid in seqids}
-    for i in range(origSNPCount):
-        if origPassedList[i]:
-            passedPosits.append(origPosits[i])
-            passedSNPData.append(snpdata[i*snpInfoRecLen:(i+1)*snpInfoRecLen])
-            for seqid in seqids:
-                passedSeqVals[seqid].append(seqvals[seqid][i*snpCallRecLen:(i+1)*snpCallRecLen])
+        readItems.append((datadir+'/'+chromoid+'_'+seqid+'.txt',snpCallRecLen,idx1,origSNPCount))
+    records=ReadRecords(readItems)
+    snpdata=records[0]
+    seqvals=dict(zip(seqids,records[1:]))
+
+    #The filter flags are at the start of each snp info record. A snp passes if none of the active filters is set
+    filterByteCount=(filterCount+5)//6
+    if filterByteCount>snpInfoRecLen:
+        raise Exception('Filter flags do not fit in snp info records')
+    filterValues=B64.B642BooleanMatrix(snpdata[:,:filterByteCount],filterCount)
+    passed=~np.any(filterValues[:,np.array(filterStatus,dtype=bool)],axis=1)
+
+    passedIdx=np.flatnonzero(passed)
+
+    #Optionally, wide windows are thinned out to the number of points the client can show
+    if 'maxpoints' in returndata:
+        maxPoints=int(returndata['maxpoints'])
+        if maxPoints<1:
+            raise Exception('Invalid maxpoints {0}'.format(maxPoints))
+        returndata['OrigCount']=len(passedIdx)
+        returndata['Decimated']=len(passedIdx)>maxPoints
+        if returndata['Decimated']:
+            decimation=returndata.get('decimation','spread')
+            passedIdx=Decimate(passedIdx,np.asarray(origPosits)[passedIdx],maxPoints,decimation,startps,endps)
 
+    passedPosits=np.asarray(origPosits)[passedIdx]
     returndata['posits']=coder.EncodeIntegersByDifferenceB64(passedPosits)
-    returndata['snpdata']=''.join(passedSNPData)
-    returndata['seqvals']={seqid:(''.join(passedSeqVals[seqid])) for seqid in passedSeqVals}
+    returndata['snpdata']=snpdata[passedIdx].tostring()
+    returndata['seqvals']={seqid:seqvals[seqid][passedIdx].tostring() for seqid in seqvals}
 
 
     DQXUtils.LogServer('Serving {0} snps, idx={4}-{5} in range {1}-{2} (size {3})'.format(len(passedPosits),startps,endps,endps-startps,idx1,idx2))
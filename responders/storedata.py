@@ -3,6 +3,7 @@
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
 import DQXDbTools
+import DQXQueryCache
 import uuid
 
 def response(returndata):
@@ -17,5 +18,6 @@ def response(returndata):
         sqlstring = 'INSERT INTO storage (id,content) VALUES ("{0}","{1}")'.format(id, request_body)
         cur.execute(sqlstring)
         cur.commit()
+        DQXQueryCache.InvalidateTable(cur.db_args['db'], 'storage')
         returndata['id']=id
         return returndata
\ No newline at end of file
@@ -3,27 +3,48 @@
 # You can find a copy of this license in LICENSE in the top directory of the source code or at <http://opensource.org/licenses/AGPL-3.0>
 
 from urlparse import parse_qs
-import importlib
 import simplejson
-import os
+import time
 import traceback
 
 import DQXUtils
 import DQXDbTools
-import responders
-from responders import uploadfile
+import DQXLogging
+import DQXMetrics
+import DQXResponders
+import arraybuffer
 
-# import customresponders
+#Import custom responder packages and preloaded responders (see DQXResponders)
+DQXResponders.Initialise()
 
-# Try to import all custom modules
-customRespondersPath = os.path.join(os.path.dirname(__file__), 'customresponders')
-for dirname in os.listdir(customRespondersPath):
-    tryModulePath = os.path.join(customRespondersPath, dirname)
-    if os.path.isdir(tryModulePath):
-        importlib.import_module('customresponders.' + dirname)
+
+#Passes on the items of a response body, adding the time needed to produce them, and their size, to the metrics
+def _MeasureEncoding(items, metricsContext):
+    iterator = iter(items)
+    while True:
+        starttime = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metricsContext.AddEncoding(time.time() - starttime, 0)
+            return
+        metricsContext.AddEncoding(time.time() - starttime, len(item))
+        yield item
 
 
 def application(environ, start_response):
+    DQXLogging.SetRequestId(DQXLogging.NewRequestId())
+    response = _Respond(environ, start_response)
+    try:
+        for item in response:
+            yield item
+    finally:
+        #The request id is thread-local, and must not leak into the next request served by this thread
+        response.close()
+        DQXLogging.SetRequestId(None)
+
+
+def _Respond(environ, start_response):
     request_data = dict((k,v[0]) for k,v in parse_qs(environ['QUERY_STRING']).items())
     if 'datatype' not in request_data:
         DQXUtils.LogServer('--> request does not contain datatype')
@@ -38,14 +59,14 @@ def application(environ, start_response):
     if request_type == 'custom':
         request_custommodule = request_data['respmodule']
         request_customid = request_data['respid']
-        responder = importlib.import_module('customresponders.' + request_custommodule + '.' + request_customid)
+        responder = DQXResponders.registry.GetCustom(request_custommodule, request_customid)
+        metricsName = 'custom.' + request_custommodule + '.' + request_customid
     else:
-        try:
-            #Fetch the handler by request type, using some introspection magic in responders/__init__.py
-            responder = getattr(responders, request_type)
-        except AttributeError:
-            raise Exception("Unknown request {0}".format(request_type))
+        responder = DQXResponders.registry.Get(request_type)
+        metricsName = request_type
 
+    metricsContext = DQXMetrics.BeginRequest(metricsName, request_data.get('database', None))
+    metricsStatus = 'ok'
 
     request_data['environ'] = environ
     response = request_data
@@ -54,32 +75,48 @@ def application(environ, start_response):
             response = responder.response(request_data)
             status = '200 OK'
         except DQXDbTools.CredentialException as e:
-            print('CREDENTIAL EXCEPTION: '+str(e))
+            DQXUtils.LogServer('CREDENTIAL EXCEPTION: '+str(e), 'CREDENTIAL')
             response['Error'] = 'Credential problem: ' + str(e)
             #Really should be 403 - but I think the JS will break as it expects 200
             #status = '403 Forbidden'
             status = '200 OK'
+            metricsStatus = 'error'
         except DQXDbTools.Timeout as e:
             status = '504 Gateway Timeout'
+            metricsStatus = 'timeout'
 
         #Check for a custom response (eg in downloadtable)
         if 'handler' in dir(responder):
-            for item in responder.handler(start_response, response):
+            for item in _MeasureEncoding(responder.handler(start_response, response), metricsContext):
+                yield item
+
+        elif 'ArrayBuffer' in response:
+        #Binary response, consisting of a set of named typed arrays
+            response_headers = [('Content-type', 'application/octet-stream'),
+                                ('Access-Control-Allow-Origin','*')]
+            start_response(status, response_headers)
+            for item in _MeasureEncoding(arraybuffer.encode_array_set(response['ArrayBuffer']), metricsContext):
                 yield item
 
         else:
         #Default is to respond with JSON
             del response['environ']
+            starttime = time.time()
             response = simplejson.dumps(response, use_decimal=True)
+            metricsContext.AddEncoding(time.time() - starttime, len(response))
             response_headers = [('Content-type', 'application/json'),
                                 ('Access-Control-Allow-Origin','*'),
                                 ('Content-Length', str(len(response)))]
             start_response(status, response_headers)
             yield response
     except Exception as e:
+        metricsStatus = 'timeout' if isinstance(e, DQXDbTools.Timeout) else 'error'
         start_response('500 Server Error', [])
         traceback.print_exc()
         yield str(e)
+    finally:
+        #Also reached when the generator is closed early, e.g. when the client disconnects during a download
+        DQXMetrics.EndRequest(metricsContext, metricsStatus)
 
-
-    DQXUtils.LogServer('Responded to {0} in wall={1}s cpu={2}s'.format(request_type, tm.Elapsed(),tm.ElapsedCPU()))
+    DQXUtils.LogServer('Responded to {0} in wall={1}s cpu={2}s'.format(request_type, tm.Elapsed(),tm.ElapsedCPU()),
+                       'RESPONSE', datatype=request_type, wall=tm.Elapsed(), cpu=tm.ElapsedCPU())
@@ -1,5 +1,5 @@
 import DQXUtils
-import DQXDbTools
+import DQXDbMetadata
 import re
 import os
 session_id_regex = re.compile("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE)
@@ -11,9 +11,7 @@ def application(environ, start_response):
         start_response('301 Moved Permanently', [('Location', 'index.html'),])
         return
 
-    with DQXDbTools.DBCursor() as cur:
-        cur.execute('select id from datasetindex')
-        datasets = [d[0] for d in cur.fetchall()]
+    datasets = DQXDbMetadata.GetDatasets()
 
     #Redirect to specific dataset
     path = environ['PATH_INFO'].split('/')
@@ -8,6 +8,7 @@ import os
 from werkzeug.wsgi import SharedDataMiddleware, DispatcherMiddleware
 import config
 from cas import CASMiddleware
+from DQXCompression import CompressionMiddleware
 import logging
 from werkzeug.contrib.sessions import FilesystemSessionStore
 from werkzeug.wrappers import Response
@@ -28,8 +29,14 @@ def ignored_callback(environ, start_response):
 general_with_static = SharedDataMiddleware(wsgi_general.application, {
     '/': os.path.join(os.path.dirname(config.__file__), 'static')
 })
+api = wsgi_api.application
+#Compress API responses for clients that accept it
+if getattr(config, 'COMPRESSION', True):
+    api = CompressionMiddleware(api,
+                                minSize = getattr(config, 'COMPRESSION_MINSIZE', 1024),
+                                level = getattr(config, 'COMPRESSION_LEVEL', 6))
 application = DispatcherMiddleware(general_with_static, {
-    '/api':        wsgi_api.application,
+    '/api':        api,
 })
 
 #Wrap in cas service if configured